@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Benchmarks the stages of creating and emailing a report, so that performance
+regressions can be caught.  Each case runs these stages for each of its sensors:
+
+    load        retrieve the sensor readings for the billing window
+    aggregate   util.heat_calcs.get_gallon_data()
+    chart       util.heat_calcs.gallons_delivered(), which includes the aggregation
+    pdf         invoice.create_invoice.create_invoice()
+    email       build the email message with the report attached (nothing is sent)
+
+The 'test' case uses the 'test-' sensors backed by the datasets in 'test-data/'.  The
+synthetic cases use generated readings for a number of sensors at a reading interval,
+served from a temporary reading store (see util.reading_cache).  The time of each stage
+is the best of several repetitions; peak memory is measured with tracemalloc in a
+separate run, so it does not slow down the timing.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --sensors 1 100 --interval 60 1 --json bench.json
+    python benchmark.py --baseline bench.json
+"""
+from datetime import timedelta
+from pathlib import Path
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import config
+
+TEST_SENSORS = ('clean_dataset', 'sensor_resets', 'missing_values', 'two_missing_months')
+STAGES = ('load', 'aggregate', 'chart', 'pdf', 'email')
+
+# Billing month used for every case; the test datasets cover 2021.
+BILL_YEAR, BILL_MONTH = 2021, 6
+
+# Expected gallons by month, for the history graph
+EXPECTED_GALLONS = {mo: 300.0 for mo in range(1, 13)}
+
+# A stage is reported as a regression if it is this much slower than the baseline.
+REGRESSION_RATIO = 1.25
+
+
+def synthetic_readings(interval_minutes, start_date, end_date):
+    """Returns readings of a synthetic BTU meter (see util.synthetic), in the NumPy format
+    of util.reading_cache, from 'start_date' through 'end_date' every 'interval_minutes'.
+    """
+    from util.reading_cache import READING_DTYPE
+    from util.synthetic import synthetic_readings as generate
+
+    ts, btus = generate(start_date, end_date, interval=interval_minutes, seed=interval_minutes)
+    readings = np.empty(len(ts), dtype=READING_DTYPE)
+    readings['ts'] = ts.view('i8')
+    readings['val'] = btus
+    return readings
+
+
+def make_cases(sensor_counts, intervals):
+    """Returns a list of (case name, list of sensor IDs, readings per sensor) for the
+    test datasets and for each combination of the synthetic 'sensor_counts' and reading
+    'intervals' (minutes).  The synthetic readings are stored in the reading store.
+    """
+    import util.heat_calcs
+    from util import reading_cache
+
+    start_date, end_date = util.heat_calcs.reading_window(BILL_YEAR, BILL_MONTH)
+    cases = [('test', [f'test-{sensor}' for sensor in TEST_SENSORS], None)]
+    for interval in intervals:
+        # the readings run a day past the window, so nothing is requested from BMON
+        readings = synthetic_readings(interval, start_date, end_date + timedelta(days=1))
+        for count in sensor_counts:
+            sensor_ids = [f'synthetic-{interval}m-{i}' for i in range(count)]
+            for i, sensor_id in enumerate(sensor_ids):
+                # sensors differ by a scale factor, so only one series is generated
+                scaled = readings.copy()
+                scaled['val'] *= 1.0 + 0.05 * i
+                reading_cache.save_readings(sensor_id, scaled, start_date)
+            cases.append((f'{count} sensors @ {interval} min', sensor_ids, len(readings)))
+    return cases
+
+
+def stage_functions(sensor_id, out_folder):
+    """Returns a dictionary of the stage functions for 'sensor_id', each taking the
+    result of the prior stage.
+    """
+    from datetime import datetime
+    import util.heat_calcs
+    import invoice.create_invoice
+    import invoice.send_invoice
+
+    start_date, end_date = util.heat_calcs.reading_window(BILL_YEAR, BILL_MONTH)
+    pdf_path = out_folder / f'{sensor_id}.pdf'
+
+    def load(_):
+        return util.heat_calcs.sensor_readings(sensor_id, config.bmon_url, start_date, end_date)
+
+    def aggregate(df):
+        util.heat_calcs.get_gallon_data(sensor_id, 1.0, config.bmon_url, BILL_YEAR, BILL_MONTH, df)
+        return df
+
+    def chart(df):
+        return util.heat_calcs.gallons_delivered(BILL_YEAR, BILL_MONTH, sensor_id, 1.0, EXPECTED_GALLONS, df)
+
+    def pdf(delivered):
+        gal_saved, bill_start, bill_end, mo_graph, hist_graph = delivered
+        if np.isnan(gal_saved):
+            invoice.create_invoice.create_no_data_invoice(pdf_path, BILL_YEAR, BILL_MONTH, datetime.now(),
+                                                          'Benchmark', 'Utility', mo_graph, hist_graph)
+            return delivered
+        invoice.create_invoice.create_invoice(pdf_path, datetime.now(), bill_start, bill_end,
+                                              'Benchmark', 'Utility', gal_saved * 2.0, gal_saved,
+                                              2.0, 5.0, gal_saved * 5.0, mo_graph, hist_graph)
+        return delivered
+
+    def email(delivered):
+        gal_saved, bill_start, bill_end, _, _ = delivered
+        if bill_start is None:
+            bill_start = bill_end = datetime(BILL_YEAR, BILL_MONTH, 1)
+        msg = invoice.send_invoice.make_email(['customer@example.com'], ['staff@example.com'], [],
+                                              bill_start, bill_end, gal_saved, gal_saved * 5.0, str(pdf_path))
+        return invoice.send_invoice.make_sender().prepare_send(**msg)
+
+    return dict(load=load, aggregate=aggregate, chart=chart, pdf=pdf, email=email)
+
+
+def run_case(sensor_ids, out_folder, repeat):
+    """Runs the stages for each of the 'sensor_ids'.  Returns dictionaries of the total
+    seconds (best of 'repeat' runs) and the peak traced memory in bytes for each stage.
+    """
+    times = {stage: np.inf for stage in STAGES}
+    peaks = {stage: 0 for stage in STAGES}
+
+    for trace in [False] * repeat + [True]:
+        run_times = dict.fromkeys(STAGES, 0.0)
+        for sensor_id in sensor_ids:
+            result = None
+            for stage, func in stage_functions(sensor_id, out_folder).items():
+                if trace:
+                    tracemalloc.start()
+                st = time.perf_counter()
+                result = func(result)
+                run_times[stage] += time.perf_counter() - st
+                if trace:
+                    peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+        if not trace:
+            times = {stage: min(times[stage], run_times[stage]) for stage in STAGES}
+
+    return times, peaks
+
+
+def print_results(records, baseline=None):
+    """Prints a table of the benchmark 'records', flagging stages that are slower than
+    the matching record in 'baseline' by more than REGRESSION_RATIO.  Returns the
+    number of regressions found.
+    """
+    baseline = {(rec['case'], rec['stage']): rec for rec in baseline or []}
+    regressions = 0
+    print(f"\n{'case':<24}{'stage':<11}{'seconds':>9}{'sec/sensor':>12}{'peak MB':>9}")
+    for rec in records:
+        line = (f"{rec['case']:<24}{rec['stage']:<11}{rec['seconds']:>9.3f}"
+                f"{rec['seconds'] / rec['sensors']:>12.4f}{rec['peak_bytes'] / 1e6:>9.1f}")
+        base = baseline.get((rec['case'], rec['stage']))
+        if base is not None:
+            ratio = rec['seconds'] / max(base['seconds'], 1e-9)
+            line += f"  {ratio:5.2f}x baseline"
+            if ratio > REGRESSION_RATIO:
+                line += '  << REGRESSION'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the report pipeline.')
+    parser.add_argument('--sensors', type=int, nargs='*', default=[1, 10],
+                        help='Numbers of synthetic sensors to benchmark (default 1 10).')
+    parser.add_argument('--interval', type=int, nargs='*', default=[60, 15],
+                        help='Synthetic reading intervals in minutes (default 60 15).')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions (default 3).')
+    parser.add_argument('--json', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the times to results in this JSON file.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # keep the synthetic readings out of the real reading store, and build emails
+        # with a placeholder sender (nothing is sent).
+        config.cache_folder = Path(tmp_dir) / 'cache'
+        config.email_user = 'benchmark@example.com'
+        out_folder = Path(tmp_dir)
+
+        records = []
+        for case, sensor_ids, n_readings in make_cases(args.sensors, args.interval):
+            print(f"Running {case}...")
+            times, peaks = run_case(sensor_ids, out_folder, args.repeat)
+            for stage in STAGES:
+                records.append(dict(case=case, stage=stage, sensors=len(sensor_ids), readings=n_readings,
+                                    seconds=times[stage], peak_bytes=peaks[stage]))
+
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    regressions = print_results(records, baseline)
+    if args.json:
+        Path(args.json).write_text(json.dumps(records, indent=2))
+    if regressions:
+        raise SystemExit(f'{regressions} stages are slower than the baseline.')
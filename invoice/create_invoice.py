@@ -12,8 +12,34 @@ from PIL import Image
 from invoice.invoice_elements import *
 
 
-def create_invoice(
-    pdf_path: Path,    # file to store invoice in
+def write_invoices(
+    pdf_path: Path,    # file to store the invoices in
+    pages: list,       # one list of page elements for each invoice
+    ):
+    """Writes a PDF with one page for each of the invoices in 'pages', each of which is
+    a list of the elements returned by invoice_elements() or no_data_invoice_elements().
+    Fonts and the logo are shared by the invoice elements, so they are stored only once
+    in the file.
+    """
+    # Create document
+    pdf = Document()
+
+    for elements in pages:
+        # Add page
+        page = Page()
+        pdf.append_page(page)
+
+        # page object for appending items
+        page_layout = SingleColumnLayout(page)
+        page_layout.vertical_margin = page.get_page_info().get_height() * Decimal(0.02)
+
+        for element in elements:
+            page_layout.add(element)
+
+    with open(pdf_path, "wb") as pdf_file_handle:
+        PDF.dumps(pdf_file_handle, pdf)
+
+def invoice_elements(
     invoice_date: datetime,
     bill_period_start: datetime,
     bill_period_end: datetime,
@@ -26,18 +52,7 @@ def create_invoice(
     fuel_value: float,
     graph_billing_period: Image,
     graph_historical_period: Image,
-    ):
-
-    # Create document
-    pdf = Document()
-
-    # Add page
-    page = Page()
-    pdf.append_page(page)
-
-    # page object for appending items
-    page_layout = SingleColumnLayout(page)
-    page_layout.vertical_margin = page.get_page_info().get_height() * Decimal(0.02)
+    ) -> list:
 
     # building the elements/building blocks of the complete invoice. 
     # set in order in which they will be added to the page object 
@@ -73,15 +88,10 @@ def create_invoice(
         table_spacing(),
         build_notes(),
     ]
-    
-    for element in building_page:
-        page_layout.add(element)
 
-    with open(pdf_path, "wb") as pdf_file_handle:
-        PDF.dumps(pdf_file_handle, pdf)
+    return building_page
 
-def create_no_data_invoice(
-    pdf_path: Path,    # file to store invoice in
+def no_data_invoice_elements(
     bill_year: int,    # the year being requested, e.g. 2021
     bill_month: int,   # the month being requested, e.g. 11
     invoice_date: datetime,
@@ -89,18 +99,7 @@ def create_no_data_invoice(
     utility: str,
     graph_billing_period: Image,
     graph_historical_period: Image,
-    ):
-
-    # Create document
-    pdf = Document()
-
-    # Add page
-    page = Page()
-    pdf.append_page(page)
-
-    # page object for appending items
-    page_layout = SingleColumnLayout(page)
-    page_layout.vertical_margin = page.get_page_info().get_height() * Decimal(0.02)
+    ) -> list:
 
     # building the elements/building blocks of the complete invoice. 
     # set in order in which they will be added to the page object 
@@ -124,9 +123,17 @@ def create_no_data_invoice(
         table_spacing(),
         build_notes(),
     ]
-    
-    for element in building_page:
-        page_layout.add(element)
 
-    with open(pdf_path, "wb") as pdf_file_handle:
-        PDF.dumps(pdf_file_handle, pdf)
\ No newline at end of file
+    return building_page
+
+def create_invoice(pdf_path: Path, *args):
+    """Stores the invoice in the file 'pdf_path'.  The remaining arguments are
+    the arguments of invoice_elements().
+    """
+    write_invoices(pdf_path, [invoice_elements(*args)])
+
+def create_no_data_invoice(pdf_path: Path, *args):
+    """Stores the invoice for a month with no billing data in the file 'pdf_path'.
+    The remaining arguments are the arguments of no_data_invoice_elements().
+    """
+    write_invoices(pdf_path, [no_data_invoice_elements(*args)])
@@ -3,6 +3,7 @@ from pathlib import Path
 from typing import Text
 from datetime import datetime
 from decimal import Decimal
+from functools import lru_cache
 
 from PIL import Image as PIL_Image
 from borb.pdf.canvas.color.color import HexColor
@@ -11,21 +12,46 @@ from borb.pdf.canvas.layout.table.table import Table
 from borb.pdf.canvas.layout.text.paragraph import Paragraph
 from borb.pdf.canvas.layout.layout_element import Alignment
 from borb.pdf.canvas.layout.image.image import Image
-
+from borb.pdf.canvas.font.simple_font.font_type_1 import StandardType1Font
+from borb.io.read.types import Decimal as pDecimal
+
+class Type1Font(StandardType1Font):
+    """A standard Type 1 font with a lookup table for glyph widths.  Borb parses the
+    AFM file every time a Paragraph is given a font name and scans all the glyphs each
+    time it measures a character, so the invoice elements share these instances instead.
+    """
+    def __init__(self, font_name=None):
+        super().__init__(font_name)
+        self._widths = {}
+        if font_name is not None:
+            self._widths = {code: pDecimal(wid) for code, wid, _ in self._afm._chars.values()}
+
+    def get_width(self, character_identifier):
+        return self._widths.get(character_identifier, pDecimal(0))
+
+REGULAR = Type1Font('Helvetica')
+BOLD = Type1Font('Helvetica-Bold')
+
+# The elements that are the same on every invoice are built once per run and
+# re-used; borb lays an element out again each time it is added to a page.
+
+@lru_cache(maxsize=None)
 def build_title() -> Table:
     table_title = FixedTable(
         number_of_columns=2, 
         number_of_rows=1,
         column_widths=[Decimal(3.0), Decimal(2.0)],
         )
-    table_title.add(
-        Image(Path('images/logo.png'), width=Decimal(200), height=Decimal(78))
-    )
+    # flatten the logo onto white once, as borb would do each time it writes the image
+    logo = PIL_Image.open(Path('images/logo.png')).convert('RGBA')
+    logo_rgb = PIL_Image.new('RGB', logo.size, (255, 255, 255))
+    logo_rgb.paste(logo, mask=logo.split()[-1])
+    table_title.add(Image(logo_rgb, width=Decimal(200), height=Decimal(78)))
     table_title.add(Paragraph(
         'Heat Recovery Savings Report', 
         font_size=24, 
         font_color=HexColor("1a1aff"), 
-        font="Helvetica-Bold",
+        font=BOLD,
         horizontal_alignment=Alignment.RIGHT,
     ))
 
@@ -52,55 +78,58 @@ def build_dates(
     # row 1
     table_000.add(Paragraph(
         'Building Owner:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         #horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
-    table_000.add(Paragraph(user, font_size=11))
+    table_000.add(Paragraph(user, font_size=11, font=REGULAR))
     table_000.add(Paragraph(
         'Report Date:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
     table_000.add(Paragraph(
         report_date.strftime('%B %d, %Y'), 
         horizontal_alignment=Alignment.RIGHT,
+        font=REGULAR,
         font_size=11
     ))
 
     #row 2
     table_000.add(Paragraph(
         'Utility:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         #horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
-    table_000.add(Paragraph(utility, font_size=11))
+    table_000.add(Paragraph(utility, font_size=11, font=REGULAR))
     table_000.add(Paragraph(
         'Prior Reading Date:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT,
         font_size=11
     ))
     table_000.add(Paragraph(
         bill_period_start.strftime('%B %d, %Y'), 
         horizontal_alignment=Alignment.RIGHT,
+        font=REGULAR,
         font_size=11
     ))
 
     # row 3
-    table_000.add(Paragraph(' '))
-    table_000.add(Paragraph(' '))
+    table_000.add(Paragraph(' ', font=REGULAR))
+    table_000.add(Paragraph(' ', font=REGULAR))
     table_000.add(Paragraph(
         'Current Reading Date:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT,
         font_size=11
     ))
     table_000.add(Paragraph(
         bill_period_end.strftime('%B %d, %Y'), 
         horizontal_alignment=Alignment.RIGHT,
+        font=REGULAR,
         font_size=11
     ))
     
@@ -133,53 +162,55 @@ def build_dates_nodata(
     # row 1
     table_000.add(Paragraph(
         'Building Owner:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         #horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
-    table_000.add(Paragraph(user, font_size=11))
+    table_000.add(Paragraph(user, font_size=11, font=REGULAR))
     table_000.add(Paragraph(
         'Report Date:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
     table_000.add(Paragraph(
         report_date.strftime('%B %d, %Y'), 
         horizontal_alignment=Alignment.RIGHT,
+        font=REGULAR,
         font_size=11
     ))
 
     #row 2
     table_000.add(Paragraph(
         'Utility:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         #horizontal_alignment=Alignment.RIGHT, 
         font_size=11
     ))
-    table_000.add(Paragraph(utility, font_size=11))
+    table_000.add(Paragraph(utility, font_size=11, font=REGULAR))
     table_000.add(Paragraph(
         'Requested Month:', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT,
         font_size=11
     ))
     table_000.add(Paragraph(
         datetime(bill_year, bill_month, 1).strftime('%B %Y'), 
         horizontal_alignment=Alignment.RIGHT,
+        font=REGULAR,
         font_size=11
     ))
 
     # row 3
-    table_000.add(Paragraph(' '))
-    table_000.add(Paragraph(' '))
+    table_000.add(Paragraph(' ', font=REGULAR))
+    table_000.add(Paragraph(' ', font=REGULAR))
     table_000.add(Paragraph(
         '**No Data for Month**', 
-        font="Helvetica-Bold", 
+        font=BOLD, 
         horizontal_alignment=Alignment.RIGHT,
         font_size=11
     ))
-    table_000.add(Paragraph(' '))
+    table_000.add(Paragraph(' ', font=REGULAR))
     
     # Format cells
     table_000.set_padding_on_all_cells(
@@ -193,9 +224,10 @@ def build_dates_nodata(
     return table_000
 
 
+@lru_cache(maxsize=None)
 def table_spacing() -> Table:
     table_space = FixedTable(number_of_rows=1, number_of_columns=1, background_color=None)
-    table_space.add(Paragraph(" ", font_size=7))
+    table_space.add(Paragraph(" ", font_size=7, font=REGULAR))
 
     # formatting cells
     table_space.set_padding_on_all_cells(1,1,1,1)
@@ -214,7 +246,7 @@ def build_invoice_amount_due(bill_amt: float) -> Table:
     
     amount_table.add(Paragraph(
         text='Expected payment to Utility for recovered heat',  
-        font='Helvetica-Bold',
+        font=BOLD,
         font_size=12,
         text_alignment=Alignment.LEFT,
     ))
@@ -224,7 +256,7 @@ def build_invoice_amount_due(bill_amt: float) -> Table:
     amount_table.add(Paragraph(
         text="${:,.2f}".format(bill_amt),
         font_size=12,
-        font='Helvetica-Bold',
+        font=BOLD,
         text_alignment=Alignment.RIGHT, 
     ))
 
@@ -232,6 +264,7 @@ def build_invoice_amount_due(bill_amt: float) -> Table:
     return amount_table
 
 
+@lru_cache(maxsize=None)
 def build_items_header() -> Table:
     header = FixedTable(
         number_of_rows=1,
@@ -240,7 +273,7 @@ def build_items_header() -> Table:
 
     header.add(Paragraph(
         text='Report Details',
-        font="Helvetica-Bold",
+        font=BOLD,
         font_size=11,
         vertical_alignment=Alignment.TOP,
     ))
@@ -276,40 +309,43 @@ def build_item_descriptions(
     ### Headers and values of invoice Items
     #row 1
     billing_days = (bill_period_end - bill_period_start).total_seconds()/(3600 * 24)
-    items_table.add(Paragraph('Days in Reporting Period', font_size=10))
-    items_table.add(Paragraph(f'{billing_days:.1f} days', text_alignment=Alignment.CENTERED, font_size=10))
+    items_table.add(Paragraph('Days in Reporting Period', font_size=10, font=REGULAR))
+    items_table.add(Paragraph(f'{billing_days:.1f} days', text_alignment=Alignment.CENTERED, font_size=10, font=REGULAR))
 
     #row 2
-    items_table.add(Paragraph('Gallons of Heating Oil you Saved', text_alignment=Alignment.LEFT, font_size=10))
+    items_table.add(Paragraph('Gallons of Heating Oil you Saved', text_alignment=Alignment.LEFT, font_size=10, font=REGULAR))
     items_table.add(Paragraph(text=f'{gal_saved:,.1f} gallons', text_alignment=Alignment.CENTERED, 
-        font_size=10))
+        font=REGULAR, font_size=10))
 
     # row
-    items_table.add(Paragraph('Price you would normally Pay per Gallon of Heating Oil **', text_alignment=Alignment.LEFT, font_size=10))
+    items_table.add(Paragraph('Price you would normally Pay per Gallon of Heating Oil **', text_alignment=Alignment.LEFT, font_size=10, font=REGULAR))
     items_table.add(Paragraph(
         text="${:,.2f} / gallon".format(retail_rate_per_gal), 
         text_alignment=Alignment.CENTERED, 
+        font=REGULAR,
         font_size=10
     ))
 
     # row
-    items_table.add(Paragraph('Price Paid for Recovered Heat', text_alignment=Alignment.LEFT, font_size=10))
+    items_table.add(Paragraph('Price Paid for Recovered Heat', text_alignment=Alignment.LEFT, font_size=10, font=REGULAR))
     items_table.add(Paragraph(
         text="${:,.2f} / gallon equivalent".format(bill_rate_per_gal), 
         text_alignment=Alignment.CENTERED, 
+        font=REGULAR,
         font_size=10
     ))
  
     #row 3
-    items_table.add(Paragraph('Your Avoided Cost of Heating Oil this month', text_alignment=Alignment.LEFT, font_size=10))
+    items_table.add(Paragraph('Your Avoided Cost of Heating Oil this month', text_alignment=Alignment.LEFT, font_size=10, font=REGULAR))
     items_table.add(Paragraph(text="${:,.0f}".format(fuel_value), text_alignment=Alignment.CENTERED, 
-        font_size=10))
+        font=REGULAR, font_size=10))
 
     #row 4
-    items_table.add(Paragraph('Your Cost Savings by using Recovered Heat this month', text_alignment=Alignment.LEFT, font_size=10))
+    items_table.add(Paragraph('Your Cost Savings by using Recovered Heat this month', text_alignment=Alignment.LEFT, font_size=10, font=REGULAR))
     items_table.add(Paragraph(
         text="${:,.0f}".format(savings), 
         text_alignment=Alignment.CENTERED,
+        font=REGULAR,
         font_size=10
     ))
 
@@ -318,6 +354,7 @@ def build_item_descriptions(
     return items_table
 
 
+@lru_cache(maxsize=None)
 def build_graph_header() -> Table:
     header = FixedTable(
         number_of_rows=1, 
@@ -328,14 +365,14 @@ def build_graph_header() -> Table:
     header.add(Paragraph(
         text='Daily Savings for Month Reported',
         text_alignment=Alignment.CENTERED,
-        font="Helvetica-Bold",
+        font=BOLD,
         font_size=11,       
     ))
 
     header.add(Paragraph(
         text='Last 12 Months',
         text_alignment=Alignment.CENTERED,
-        font="Helvetica-Bold",
+        font=BOLD,
         font_size=11,
     ))
 
@@ -349,6 +386,7 @@ def build_graph_images(
     ) -> Table:
     image_table = FixedTable(number_of_rows=1, number_of_columns=2)
     
+    # the graphs are drawn to fit this size; see util.heat_calcs.GRAPH_SLOT
     im_wid = Decimal(230)
     im_ht = Decimal(140)
     image_table.add(Image(graph_month, width=im_wid, height=im_ht))
@@ -359,20 +397,24 @@ def build_graph_images(
 
     return image_table
 
+@lru_cache(maxsize=None)
 def build_notes():
     notes_table = FixedTable(number_of_rows=5, number_of_columns=1)
     notes_table.add(Paragraph(
         text='X symbols in the above graphs indicate a period with No Data or a period of abnormal length.',
+        font=REGULAR,
         font_size=10,
     ))
-    notes_table.add(Paragraph(text=' '))
+    notes_table.add(Paragraph(text=' ', font=REGULAR))
     notes_table.add(Paragraph(
         text='** From State of Alaska community database.  If this figure is not accurate, email energy@anthc.org with the correct cost per gallon.',
+        font=REGULAR,
         font_size=10,
     ))
-    notes_table.add(Paragraph(text=' '))
+    notes_table.add(Paragraph(text=' ', font=REGULAR))
     notes_table.add(Paragraph(
         text='This monthly report is intended to show you how much heat recovered from the nearby power plant was used to used to heat your building. It will also show your savings if you had to heat your entire building using your boiler or furnace.',
+        font=REGULAR,
         font_size=10,
     ))
     notes_table.no_borders()
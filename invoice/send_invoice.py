@@ -1,9 +1,32 @@
 """Module for creating and sending an email containing the Heat Recovery report.
+
+A batch of emails is sent by send_emails() over one SMTP connection per sending thread,
+rather than logging in to the mail server again for each email.
 """
-import yagmail
 from datetime import datetime
+from pathlib import Path
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING
 
 import config
+from util import timing
+
+if TYPE_CHECKING:
+    import yagmail
+
+# Number of SMTP connections used to send a batch of emails
+EMAIL_CONNECTIONS = getattr(config, 'email_connections', 2)
+
+# Maximum number of emails sent per minute, across all connections (None for no limit)
+EMAIL_MAX_PER_MINUTE = getattr(config, 'email_max_per_minute', 60)
+
+# Number of times sending an email is retried after a temporary failure, and the delay
+# in seconds before the first retry.  The delay doubles for each subsequent retry.
+SEND_RETRIES = 3
+SEND_RETRY_DELAY = 5.0
 
 
 def send_email(
@@ -16,37 +39,174 @@ def send_email(
     fuel_value: float,
     pdf_file_name: str,
 ):
-    """Main function to call to create and send an email of the Heat Recovery Report.
+    """Main function to call to create and send one email of the Heat Recovery Report.
+    Use send_emails() to send the reports for many customers.
     """
+    email = make_email(to_addresses, to_cc, to_bcc, billing_period_start, billing_period_end,
+                       gal_saved, fuel_value, pdf_file_name)
+    for _, err in send_emails([email], connections=1):
+        if err is not None:
+            raise err
 
-    subject = email_subject(
-        billing_period_start=billing_period_start,
-        billing_period_end=billing_period_end
-    )
-    contents = email_contents(
-        billing_period_start=billing_period_start,
-        billing_period_end=billing_period_end,
-        gal_saved=gal_saved,
-        fuel_value=fuel_value
-    )
 
-    yag_sender = make_sender()
-    yag_sender.send(
+def make_email(
+    to_addresses: list,
+    to_cc: list,
+    to_bcc: list,
+    billing_period_start: datetime,
+    billing_period_end: datetime,
+    gal_saved: float,
+    fuel_value: float,
+    pdf_file_name: str,
+) -> dict:
+    """Returns a dictionary describing the email of a Heat Recovery Report, which can
+    be passed to send_emails().  The keys are arguments of yagmail's SMTP.send().
+    """
+    return dict(
         to=to_addresses,
         cc=to_cc,
         bcc=to_bcc,
-        subject=subject,
-        contents=contents,
+        subject=email_subject(
+            billing_period_start=billing_period_start,
+            billing_period_end=billing_period_end
+        ),
+        contents=email_contents(
+            billing_period_start=billing_period_start,
+            billing_period_end=billing_period_end,
+            gal_saved=gal_saved,
+            fuel_value=fuel_value
+        ),
         attachments=pdf_file_name,
     )
 
 
+def send_emails(
+    emails: list,                       # email dictionaries from make_email()
+    connections: int = EMAIL_CONNECTIONS,
+    max_per_minute: float = EMAIL_MAX_PER_MINUTE,
+):
+    """Sends the 'emails' using up to 'connections' SMTP connections at once, each of which
+    is logged in to once and used for many emails.  No more than 'max_per_minute' emails
+    are sent per minute.  Sending an email is retried after a temporary failure.
+    This is a generator that yields an (email, error) tuple as each email is finished;
+    'error' is None if the email was sent, otherwise the exception that stopped it.
+    """
+    throttle = _Throttle(max_per_minute)
+    thread_data = threading.local()
+    senders = []
+    senders_lock = threading.Lock()
+
+    def send_one(email):
+        # each thread keeps its own connection to the mail server
+        if not hasattr(thread_data, 'sender'):
+            thread_data.sender = _PooledSender()
+            with senders_lock:
+                senders.append(thread_data.sender)
+        try:
+            with timing.labels(report=Path(email['attachments']).name):
+                thread_data.sender.send(email, throttle)
+            return email, None
+        except Exception as err:
+            return email, err
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as executor:
+            for fut in as_completed([executor.submit(send_one, email) for email in emails]):
+                yield fut.result()
+    finally:
+        for sender in senders:
+            sender.close()
+
+
+class _Throttle:
+    """Spaces out the start of sends, across threads, to no more than 'max_per_minute'.
+    """
+    def __init__(self, max_per_minute):
+        self.interval = 60.0 / max_per_minute if max_per_minute else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+class _PooledSender:
+    """A yagmail sender whose SMTP connection is kept open between emails.  yagmail's own
+    SMTP.send() logs in to the server again for every email.
+    """
+    def __init__(self):
+        self.yag = make_sender()
+        self.connected = False
+
+    def send(self, email, throttle):
+        """Sends the 'email' dictionary, reconnecting and retrying after temporary failures.
+        """
+        with timing.span('email_render'):
+            recipients, msg_bytes = self.yag.prepare_send(**email)
+            # yagmail builds the message with bare LF line endings; SMTP requires CRLF
+            msg_bytes = b'\r\n'.join(msg_bytes.splitlines())
+        delay = SEND_RETRY_DELAY
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                if not self.connected:
+                    with timing.span('smtp_login'):
+                        self.yag.login()
+                    self.connected = True
+                throttle.wait()
+                with timing.span('smtp_send'):
+                    self.yag.smtp.sendmail(self.yag.user, recipients, msg_bytes)
+                return
+            except Exception as err:
+                if attempt == SEND_RETRIES or not _is_temporary(err):
+                    raise
+                # reconnect before trying again
+                self.close()
+            time.sleep(delay)
+            delay *= 2
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.yag.close()
+
+
+def _is_temporary(err) -> bool:
+    """Returns True if the SMTP exception 'err' is a failure that may succeed if retried:
+    a lost connection, a network error or a 4xx reply from the server.
+    """
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in err.recipients.values())
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 400 <= err.smtp_code < 500
+    if isinstance(err, smtplib.SMTPServerDisconnected):
+        return True
+    # other SMTP errors are also OSErrors, but are not network errors
+    return isinstance(err, OSError) and not isinstance(err, smtplib.SMTPException)
+
+
 ### Functions used to build the email
 
-def make_sender() -> yagmail.sender.SMTP:
-    """Use credentials in the config file to make a yagmail sender.
+def make_sender() -> 'yagmail.SMTP':
+    """Use credentials in the config file to make a yagmail sender.  The mail server
+    defaults to Gmail; 'email_host', 'email_port', 'email_ssl' and 'email_starttls' in 
+    the config file can select another server, e.g. a local test server, and 
+    'email_skip_login' skips logging in for a server without authentication.
     """
-    return yagmail.SMTP(user=config.email_user, password=config.email_password)
+    import yagmail
+
+    return yagmail.SMTP(
+        user=config.email_user, 
+        password=config.email_password,
+        host=getattr(config, 'email_host', 'smtp.gmail.com'),
+        port=getattr(config, 'email_port', None),
+        smtp_ssl=getattr(config, 'email_ssl', True),
+        smtp_starttls=getattr(config, 'email_starttls', None),
+        smtp_skip_login=getattr(config, 'email_skip_login', False),
+    )
 
 
 def email_subject(
@@ -1,20 +1,25 @@
 #!/usr/bin/env python3
 """Main script to generate and email heat recovery reports.
+
+The modules for calculations, graphing, PDF creation and email are imported by the
+routines that use them, so the program starts quickly and each task only loads
+what it needs.
 """
 from datetime import datetime
 from pathlib import Path
-import pickle
+import argparse
+import io
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from questionary import select, checkbox, Choice
-import numpy as np
+import rich
 from rich import print as rprint
+from rich.text import Text
 
 import config
 import util.data_util
-from util.data_util import akwarm_city_data, chgnan
-import util.heat_calcs
-import invoice.create_invoice
-import invoice.send_invoice
+from util.data_util import chgnan
+from util import results_store, email_outbox, timing
 
 
 def make_report_file_name(customer_name, customer_city, billing_year, billing_month):
@@ -30,19 +35,47 @@ def create_report(
     billing_month, 
     akwarm_city_data, 
     util_fuel_prices, 
-    results,                # dictionary of results (modified by this routine)
+    report_folder,
+    df_readings=None,       # sensor readings to use instead of retrieving them
+    pages=None,             # if a list, the invoice page is recorded here (see below)
+    gallon_data=None,       # precomputed get_gallon_data() results, see fleet_gallon_data()
+    stream=False,           # if True, process the readings a chunk at a time
 ):
+    """Creates the Heat Recovery report for one customer and billing month, storing
+    the PDF in 'report_folder'.  Returns a tuple: the report file name and a dictionary
+    of summary results for the report.  The summary results are None if there was
+    no billing data for the month.
+    If 'pages' is a list, a (report file name, invoice elements function name, arguments)
+    tuple is appended to it so the invoice can also be added to a combined PDF.
+    If 'stream' is True, the readings are processed a chunk at a time (see 
+    util.heat_calcs.stream_gallon_data()) so memory use stays small for high-frequency meters.
+    """
+    import numpy as np
+    import util.heat_calcs
+    import invoice.create_invoice
 
     # make a dictionary mapping month number to expected gallon savings
     expected_gallons = {}
     for mo in range(1, 13):
         expected_gallons[mo] =  customer[f'feas_g_{mo:02d}']
 
+    # calculate the gallons saved, using the stored totals of prior months where possible
+    # (see util.monthly_rollups) so that only the billing month's readings are needed.
+    if gallon_data is None and stream:
+        with timing.span('aggregate'):
+            chunks = util.heat_calcs.reading_chunks(customer['sensor_id'], config.bmon_url,
+                                                    *util.heat_calcs.reading_window(billing_year, billing_month))
+            gallon_data = util.heat_calcs.stream_gallon_data(chunks, customer['btu_mult'], billing_year, billing_month)
+    elif gallon_data is None:
+        gallon_data = util.heat_calcs.rollup_gallon_data(customer['sensor_id'], customer['btu_mult'], config.bmon_url,
+                                                         billing_year, billing_month, df_readings)
+
     # determine gallons to bill and billing date range for the customer.
     gal_saved, bill_start, bill_end, mo_graph, hist_graph = util.heat_calcs.gallons_delivered(
-                billing_year, billing_month, customer['sensor_id'], customer['btu_mult'], expected_gallons)
+                billing_year, billing_month, customer['sensor_id'], customer['btu_mult'], expected_gallons,
+                gallon_data=gallon_data)
 
-    path_report = report_folder / make_report_file_name(customer['customer'], customer['city'], year, month)
+    path_report = report_folder / make_report_file_name(customer['customer'], customer['city'], billing_year, billing_month)
 
     if not np.isnan(gal_saved):
 
@@ -85,8 +118,7 @@ def create_report(
         else:
             cust_price = akwarm_fuel_price * (1.0 - chgnan(customer['cust_fuel_disc'], 0.0))
         
-        invoice.create_invoice.create_invoice(
-            path_report,
+        invoice_args = (
             datetime.now(),
             bill_start,
             bill_end,
@@ -100,21 +132,25 @@ def create_report(
             mo_graph,
             hist_graph
         )
+        with timing.span('pdf'):
+            invoice.create_invoice.create_invoice(path_report, *invoice_args)
+        if pages is not None:
+            pages.append((path_report.name, 'invoice_elements', invoice_args))
 
-        # update the results dictionary
-        results[path_report.name] = dict(
+        rprint(f"[green3]Completed: {gal_saved:,.0f} gallons saved")
+
+        # summary results for the report
+        return path_report.name, dict(
             gal_saved = gal_saved,
             bill_start = bill_start,
             bill_end = bill_end,
             billed_price = billed_price,
             cust_price = cust_price
         )
-        rprint(f"[green3]Completed: {gal_saved:,.0f} gallons saved")
 
     else:
         rprint("[purple]No BTU Meter Data available during this billing period.")
-        invoice.create_invoice.create_no_data_invoice(
-            path_report,    # file to store invoice in
+        invoice_args = (
             billing_year,    # the year being requested, e.g. 2021
             billing_month,   # the month being requested, e.g. 11
             datetime.now(),
@@ -123,22 +159,412 @@ def create_report(
             mo_graph,
             hist_graph
         )
+        with timing.span('pdf'):
+            invoice.create_invoice.create_no_data_invoice(path_report, *invoice_args)
+        if pages is not None:
+            pages.append((path_report.name, 'no_data_invoice_elements', invoice_args))
         rprint(f"[green3]Completed report, but no billing data.")
+        return path_report.name, None
+
+
+def create_customer_reports(
+    customer,
+    billing_months,         # list of (year, month) tuples to create reports for
+    akwarm_city_data,
+    util_fuel_prices,
+    report_folder,
+    pages=None,             # if a list, invoice pages are recorded here; see create_report()
+    gallon_data=None,       # dictionary of precomputed results by (year, month), see fleet_gallon_data()
+    stream=False,           # if True, process the readings a chunk at a time; see create_report()
+):
+    """Creates the Heat Recovery reports for one customer for each of the 'billing_months'.
+    The customer's sensor readings are retrieved once for all of the months, unless 
+    'gallon_data' has the calculated results for every month or 'stream' is True.  Returns
+    a list of (billing year, billing month, report file name, summary results) tuples, 
+    the last two items being those returned by create_report().
+    An error in one month is printed and does not stop the reports for other months.
+    """
+    import util.heat_calcs
+
+    gallon_data = gallon_data or {}
+    customer_labels = timing.labels(customer=f"{customer['city']} - {customer['customer']}", 
+                                    sensor_id=customer['sensor_id'])
+    with customer_labels:
+        if len(billing_months) == 1:
+            year, month = billing_months[0]
+            with timing.labels(month=f'{year}-{month:02d}'):
+                return [(year, month, *create_report(customer, year, month, akwarm_city_data, 
+                                                     util_fuel_prices, report_folder, pages=pages,
+                                                     gallon_data=gallon_data.get((year, month)), stream=stream))]
+
+        df_readings = None
+        if not stream and not all(month in gallon_data for month in billing_months):
+            start_date, _ = util.heat_calcs.reading_window(*billing_months[0])
+            _, end_date = util.heat_calcs.reading_window(*billing_months[-1])
+            with timing.span('load'):
+                df_readings = util.heat_calcs.sensor_readings(customer['sensor_id'], config.bmon_url, 
+                                                              start_date, end_date)
+
+        report_results = []
+        for year, month in billing_months:
+            rprint(f"{year}-{month:02d}:")
+            try:
+                with timing.labels(month=f'{year}-{month:02d}'):
+                    report_results.append((year, month, *create_report(customer, year, month, akwarm_city_data, 
+                                                        util_fuel_prices, report_folder, df_readings, pages,
+                                                        gallon_data.get((year, month)), stream)))
+            except Exception as err:
+                rprint(f"[red]Error: {err}")
+
+        return report_results
+
+
+def init_worker(trace_memory=False, fresh_since=None):
+    """Initializes a report worker process.  Each worker draws graphs on its own
+    Matplotlib figures (see util.heat_calcs), and the messages it prints are recorded
+    so they can be returned to the main process instead of being interleaved with 
+    other workers.  If 'trace_memory' is True, the memory used by each stage is traced.
+    'fresh_since' is passed on to util.reading_cache, so the worker uses the readings
+    downloaded by the main process without contacting BMON.
+    """
+    from util import reading_cache
 
+    rich.reconfigure(record=True, file=io.StringIO(), force_terminal=True)
+    reading_cache.fresh_since = fresh_since
+    if trace_memory:
+        tracemalloc.start()
 
-if __name__ == '__main__':
 
-    rprint('\n[blue]------- ANTHC Heat Recovery Reporting Program -------\n')
-    rprint('[red]Red messages indicate an error that will stop report creation for that customer.')
-    rprint('[purple]Purple messages indicate an error that will cause missing information in the report.')
-    rprint('[green3]A Green message indicates a report was completed.\n')
-    print('Acquiring data...\n')
-    cust_recs = util.data_util.customer_records()
-    util_fuel_prices = util.data_util.utility_fuel_prices()
-    akwarm_city_data, akwarm_lib_version = util.data_util.akwarm_city_data()
-    #from pickle import dump, load
-    #dump( (util_fuel_prices, akwarm_city_data), open('data.pkl', 'wb'))
-    #util_fuel_prices, akwarm_city_data = load(open('data.pkl', 'rb'))
+def create_report_worker(*args, collect_pages=False, gallon_data=None, stream=False):
+    """Runs create_customer_reports() in a worker process, with the customer's precomputed
+    'gallon_data' if given and streaming the readings if 'stream' is True.  Returns the 
+    create_customer_reports() results, the text printed while creating the reports,
+    the list of invoice pages (None if 'collect_pages' is False) and the timing spans
+    recorded (see util.timing).
+    If an error occurs, the error is returned in place of the results.
+    """
+    pages = [] if collect_pages else None
+    try:
+        result = create_customer_reports(*args, pages=pages, gallon_data=gallon_data, stream=stream)
+    except Exception as err:
+        result = err
+    return result, rich.get_console().export_text(styles=True), pages, timing.take_records()
+
+
+def fleet_key(customer):
+    """Returns the key of the customer's results from fleet_gallon_data().
+    """
+    return customer['sensor_id'], customer['btu_mult']
+
+
+def fleet_gallon_data(target_customers, billing_months):
+    """Retrieves the sensor readings of all the 'target_customers' and calculates the
+    gallons saved for every customer at once, for each of the 'billing_months' (see
+    util.heat_calcs.fleet_gallon_data()).  Returns a dictionary mapping fleet_key() of
+    a customer to a dictionary of the get_gallon_data() results by (year, month).  
+    Customers whose readings could not be retrieved or calculated are left out, so their
+    reports retrieve the readings themselves and report any error.
+    """
+    import util.heat_calcs
+
+    start_date, _ = util.heat_calcs.reading_window(*billing_months[0])
+    _, end_date = util.heat_calcs.reading_window(*billing_months[-1])
+    readings = {}
+    for customer in target_customers:
+        key = fleet_key(customer)
+        if key in readings:
+            continue
+        try:
+            with timing.labels(customer=f"{customer['city']} - {customer['customer']}", 
+                               sensor_id=customer['sensor_id']), timing.span('load'):
+                df = util.heat_calcs.sensor_readings(customer['sensor_id'], config.bmon_url, start_date, end_date)
+            readings[key] = (df, customer['btu_mult'])
+        except Exception:
+            pass
+
+    print(f"\nCalculating gallons saved for {len(readings)} sensors...")
+    fleet_data = {}
+    for year, month in billing_months:
+        with timing.span('aggregate'):
+            month_data = util.heat_calcs.fleet_gallon_data(readings, year, month)
+        for key, data in month_data.items():
+            fleet_data.setdefault(key, {})[(year, month)] = data
+    return fleet_data
+
+
+def create_reports(
+    target_customers,
+    billing_months,         # list of (year, month) tuples to create reports for
+    akwarm_city_data,
+    util_fuel_prices,
+    report_folder,
+    results,                # results database connection, see util.results_store
+    workers=1,              # number of worker processes to create the reports with
+    pages=None,             # if a list, invoice pages are recorded here; see create_report()
+    fleet=False,            # if True, calculate for all customers at once; see fleet_gallon_data()
+    stream=False,           # if True, process the readings a chunk at a time; see create_report()
+):
+    """Creates reports for each of the 'target_customers' for each of the 'billing_months'.
+    If 'workers' is more than 1, the customers are processed in parallel by a pool of 
+    processes.  The summary results from each report are saved in the 'results' database
+    as each customer is completed.
+    """
+    fleet_data = fleet_gallon_data(target_customers, billing_months) if fleet else {}
+
+    def customer_label(customer):
+        return f"{customer['city']} - {customer['customer']}"
+
+    def store_results(customer, report_results):
+        for year, month, report_fn, summary in report_results:
+            if summary is not None:
+                try:
+                    results_store.save_result(results, report_fn, customer['city'], customer['customer'], 
+                                              customer['sensor_id'], year, month, summary)
+                except Exception as err:
+                    rprint(f'[red]Error saving summary results for {report_fn}: {err}')
+
+    if workers <= 1:
+        for customer in target_customers:
+            print(f"\nProcessing: {customer_label(customer)}")
+            try:
+                store_results(customer, create_customer_reports(customer, billing_months, 
+                        akwarm_city_data, util_fuel_prices, report_folder, pages, 
+                        fleet_data.get(fleet_key(customer)), stream))
+            except BaseException as err:
+                rprint(f"[red]Error: {err}")
+        return
+
+    from util import reading_cache
+
+    print(f"\nCreating reports using {workers} worker processes...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, 
+                             initargs=(tracemalloc.is_tracing(), reading_cache.fresh_since)) as executor:
+        futures = {}
+        for customer in target_customers:
+            fut = executor.submit(create_report_worker, customer, billing_months,
+                                  akwarm_city_data, util_fuel_prices, report_folder,
+                                  collect_pages=pages is not None,
+                                  gallon_data=fleet_data.get(fleet_key(customer)), stream=stream)
+            futures[fut] = customer
+
+        for fut in as_completed(futures):
+            print(f"\nProcessing: {customer_label(futures[fut])}")
+            try:
+                report_results, output, worker_pages, worker_spans = fut.result()
+                rprint(Text.from_ansi(output.rstrip('\n')))
+                timing.add_records(worker_spans)
+                if worker_pages:
+                    pages.extend(worker_pages)
+                if isinstance(report_results, Exception):
+                    raise report_results
+                store_results(futures[fut], report_results)
+            except BaseException as err:
+                rprint(f"[red]Error: {err}")
+
+
+def make_bulk_file_name(billing_months, extension):
+    """Returns the file name, with the 'extension' (e.g. 'pdf'), for a file holding 
+    all the reports for the 'billing_months', a list of (year, month) tuples.
+    """
+    first, last = billing_months[0], billing_months[-1]
+    months = f"{first[0]}-{first[1]:02d}"
+    if last != first:
+        months += f" to {last[0]}-{last[1]:02d}"
+    return f"{months} - All Reports.{extension}"
+
+
+def write_bulk_reports(
+    pages,                  # invoice pages recorded by create_reports()
+    billing_months,         # list of (year, month) tuples the reports are for
+    report_folder,
+    combined=True,          # if True, write all the invoices into one PDF
+    zip_reports=False,      # if True, write a zip file of the individual report files
+):
+    """Writes the reports recorded in 'pages' to 'report_folder' as one combined PDF
+    and/or a zip file of the individual report PDFs.  The reports are ordered by
+    report file name.
+    """
+    import zipfile
+    import invoice.create_invoice
+
+    pages = sorted(pages, key=lambda page: page[0])
+
+    if combined:
+        path_combined = report_folder / make_bulk_file_name(billing_months, 'pdf')
+        print(f"\nWriting {len(pages)} reports to {path_combined.name}")
+        try:
+            invoice.create_invoice.write_invoices(path_combined, [
+                getattr(invoice.create_invoice, elements_func)(*args) 
+                for _, elements_func, args in pages
+            ])
+        except BaseException as err:
+            rprint(f"[red]Error: {err}")
+
+    if zip_reports:
+        path_zip = report_folder / make_bulk_file_name(billing_months, 'zip')
+        print(f"\nWriting {len(pages)} reports to {path_zip.name}")
+        try:
+            with zipfile.ZipFile(path_zip, 'w', zipfile.ZIP_DEFLATED) as zip_fh:
+                for report_fn, _, _ in pages:
+                    zip_fh.write(report_folder / report_fn, report_fn)
+        except BaseException as err:
+            rprint(f"[red]Error: {err}")
+
+
+def email_reports(
+    target_customers,
+    billing_months,         # list of (year, month) tuples to email reports for
+    report_folder,
+    results,                # results database connection, see util.results_store
+    dry_run=False,          # if True, only list the emails that would be sent
+    resend=False,           # if True, email reports that were already emailed again
+    queue_only=False,       # if True, only queue the emails; see send_outbox()
+):
+    """Emails the reports for each of the 'billing_months' to each of the 'target_customers'.
+    The emails are first queued in the outbox (see util.email_outbox), skipping reports
+    that were already emailed unless 'resend' is True, and then sent with send_outbox().
+    """
+    import invoice.send_invoice
+
+    queued = []     # report file names of the emails queued
+
+    for customer, (billing_year, billing_month) in [(c, m) for c in target_customers for m in billing_months]:
+
+        print(f"\nProcessing: {customer['city']} - {customer['customer']}")
+        if len(billing_months) > 1:
+            print(f"{billing_year}-{billing_month:02d}:")
+
+        try:
+            if len(customer['cust_email']) > 0 or len(customer['anthc_emails']) > 0:
+
+                # retrieve summary results for this customer's report for the billing month
+                report_fn = make_report_file_name(customer['customer'], customer['city'], billing_year, billing_month)
+                cr = results_store.get_result(results, customer['city'], customer['customer'], 
+                                              billing_year, billing_month)
+                if cr is None:
+                    raise ValueError(f'No summary results for {report_fn}; has the report been created?')
+
+                entry = email_outbox.get_entry(results, report_fn)
+                if entry is not None and entry['state'] == email_outbox.SENT and not resend:
+                    print(f"{report_fn} was already emailed on {entry['updated'][:10]}; use --resend to email it again.")
+                    continue
+
+                to_addresses = [cust.strip() for cust in customer['cust_email'].split(',')]
+                to_cc = [addr.strip() for addr in customer['anthc_emails'].split(',')]
+                if dry_run:
+                    print(f"Would email {report_fn} to: {', '.join(to_addresses + to_cc)}")
+                    continue
+
+                print(f"Queuing email of {report_fn} to: {', '.join(to_addresses + to_cc)}")
+                email = invoice.send_invoice.make_email(
+                    to_addresses = to_addresses,
+                    to_cc = to_cc,
+                    to_bcc = [],
+                    billing_period_start = cr['bill_start'],
+                    billing_period_end = cr['bill_end'],
+                    gal_saved = cr['gal_saved'],
+                    fuel_value = cr['gal_saved'] * cr['cust_price'],
+                    pdf_file_name = str(report_folder / report_fn),
+                )
+                email_outbox.queue_email(results, report_fn, email)
+                queued.append(report_fn)
+
+            else:
+                rprint('[red]No recipients listed in the customer spreadsheet.')
+
+        except BaseException as err:
+            rprint(f"[red]Error: {err}")
+            #raise err
+
+    if queued and not queue_only:
+        send_outbox(results, queued)
+
+
+def send_outbox(
+    results,                # results database connection, see util.results_store
+    report_fns=None,        # if given, only the emails for these report file names are sent
+):
+    """Sends the pending and failed emails in the outbox (see util.email_outbox), reusing
+    connections to the mail server; see invoice.send_invoice.send_emails().  Each email
+    is marked sent or failed as soon as it is finished, so an interrupted run can be 
+    resumed by sending the outbox again.
+    """
+    import invoice.send_invoice
+
+    entries = email_outbox.unsent(results, report_fns)
+    if not entries:
+        print('\nNo emails to send.')
+        return
+
+    print(f"\nSending {len(entries)} emails...")
+    report_names = {id(entry['email']): entry['report_fn'] for entry in entries}
+    for email, err in invoice.send_invoice.send_emails([entry['email'] for entry in entries]):
+        report_fn = report_names[id(email)]
+        if err is None:
+            email_outbox.mark_sent(results, report_fn)
+            rprint(f"[green3]{report_fn}: Email sent!")
+        else:
+            email_outbox.mark_failed(results, report_fn, err)
+            rprint(f"[red]{report_fn}: Error: {err}")
+
+
+def select_customers(cust_recs, cities=None, customers=None, sensor_ids=None):
+    """Returns the customer records from 'cust_recs' that match any of the 'cities',
+    'customers' (customer names) or 'sensor_ids'.  Matching of city and customer names
+    is not case sensitive.  If no criteria are given, all customer records are returned.
+    """
+    if not (cities or customers or sensor_ids):
+        return list(cust_recs)
+
+    cities = {c.lower() for c in cities or []}
+    customers = {c.lower() for c in customers or []}
+    sensor_ids = set(sensor_ids or [])
+    return [
+        rec for rec in cust_recs
+        if rec['city'].lower() in cities 
+            or rec['customer'].lower() in customers 
+            or rec['sensor_id'] in sensor_ids
+    ]
+
+
+def month_arg(text):
+    """Converts a month given on the command line as YYYY-MM into a (year, month) tuple.
+    """
+    try:
+        d = datetime.strptime(text, '%Y-%m')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{text}' is not a month in the form YYYY-MM")
+    return d.year, d.month
+
+
+def month_range(first_month, last_month):
+    """Returns a list of (year, month) tuples from 'first_month' through 'last_month',
+    which are also (year, month) tuples.
+    """
+    months = []
+    year, month = first_month
+    while (year, month) <= last_month:
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def prior_month():
+    """Returns (year, month) of the month prior to the current month.
+    """
+    cur_date = datetime.now()
+    if cur_date.month == 1:
+        return cur_date.year - 1, 12
+    else:
+        return cur_date.year, cur_date.month - 1
+
+
+def prompt_for_run(cust_recs):
+    """Interactively asks the user for the task, the customers and the billing month.
+    Returns a tuple: task ('create' or 'email'), list of target customer records, 
+    billing year, billing month.
+    """
+    from questionary import select, checkbox, Choice
 
     task_choices = [
         'Create Reports',
@@ -192,68 +618,193 @@ if __name__ == '__main__':
     ).ask()
     year = int(year)
 
-    # Make sure the output directory for reports exists.
-    report_folder = Path(config.report_folder)
-    try:
-        report_folder.mkdir(parents=True, exist_ok=True)
-    except:
-        rprint(f"[red]Error creating the Report directory specified in the configuration file:[\red]\n{config.report_folder}")
+    return task, target_customers, year, month
 
-    # Loop through the customers to bill
-
-    # Read the database that holds the summary results from each report created
-    # 'results' is a dictionary, with the keys being report file names and the values
-    # being dictionaries of summary values.
-    results_path = report_folder / 'results.pkl'
-    if Path(results_path).exists():
-        with open(results_path, 'rb') as results_fh:
-            results = pickle.load(results_fh)
-    else:
-        results = {}
 
-    for customer in target_customers:
+def parse_args(argv=None):
+    """Parses the command line.  If no task is given, the program runs interactively.
+    """
+    parser = argparse.ArgumentParser(
+        description='Create and email Heat Recovery reports.  If no task is given, '
+                    'the task, customers and billing month are requested interactively.')
+    parser.add_argument('task', nargs='?', choices=['create', 'email', 'send'],
+                        help="Task to run without prompting.  'send' sends the emails waiting in the "
+                             "outbox, e.g. those that failed or were queued with --queue-only.")
+    parser.add_argument('--year', type=int, help='Year to bill (default is year of prior month).')
+    parser.add_argument('--month', type=int, choices=range(1, 13), metavar='{1-12}',
+                        help='Month to bill (default is prior month).')
+    parser.add_argument('--from', dest='from_month', type=month_arg, metavar='YYYY-MM',
+                        help='First month of a range of months to bill; used with --to.')
+    parser.add_argument('--to', dest='to_month', type=month_arg, metavar='YYYY-MM',
+                        help='Last month of a range of months to bill; used with --from.')
+    parser.add_argument('--city', action='append', default=[],
+                        help='Process customers in this city; may be repeated.')
+    parser.add_argument('--customer', action='append', default=[],
+                        help='Process the customer with this name; may be repeated.')
+    parser.add_argument('--sensor-id', action='append', default=[],
+                        help='Process the customer with this BTU sensor ID; may be repeated.')
+    parser.add_argument('--output', default=None,
+                        help='Folder for reports (default is report_folder in the config file).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used to create reports in parallel (default 1).')
+    parser.add_argument('--fleet', action='store_true',
+                        help='Calculate the gallons saved for all the customers in one pass before creating '
+                             'the reports; faster for many customers, but holds all the readings in memory.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Process each sensor\'s readings a chunk at a time, keeping memory use small '
+                             'for very high-frequency BTU meters.')
+    parser.add_argument('--download-threads', type=int, default=8,
+                        help='Number of BMON sensors downloaded at the same time (default 8).')
+    parser.add_argument('--refresh-readings', action='store_true',
+                        help='Discard locally stored BMON readings and monthly totals for the customers '
+                             'and download the readings again.')
+    parser.add_argument('--refresh-sheets', action='store_true',
+                        help='Read the customer spreadsheet from Google Sheets even if a recent copy is stored locally.')
+    parser.add_argument('--combined', action='store_true',
+                        help='Also write all the reports created into one PDF file.')
+    parser.add_argument('--zip', action='store_true',
+                        help='Also write a zip file of the report files created.')
+    parser.add_argument('--resend', action='store_true',
+                        help='Email reports again even if they were already emailed.')
+    parser.add_argument('--queue-only', action='store_true',
+                        help="Put the emails in the outbox without sending them; use the 'send' task to send them.")
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the time spent in each stage for each customer at the end of the run.')
+    parser.add_argument('--timing-json', metavar='FILE',
+                        help='Save the time of each stage for each customer and month to a JSON file.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also record the peak memory of each stage (saved with --timing-json); slows the run.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the run with cProfile and save the statistics to FILE.  Only the main '
+                             'process is profiled, so use with --workers 1.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='List the reports or emails that would be processed without doing them.')
+    args = parser.parse_args(argv)
+    if (args.from_month is None) != (args.to_month is None):
+        parser.error('--from and --to must be used together.')
+    if args.from_month and (args.year or args.month):
+        parser.error('--year and --month cannot be used with --from and --to.')
+    return args
 
-        print(f"\nProcessing: {customer['city']} - {customer['customer']}")
 
-        try:
-            if task == 'create':
-                create_report(customer, year, month, akwarm_city_data, util_fuel_prices, results)
+if __name__ == '__main__':
 
-            elif task == 'email':
+    args = parse_args()
+    if args.trace_memory:
+        tracemalloc.start()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-                if len(customer['cust_email']) > 0 or len(customer['anthc_emails']) > 0:
+    rprint('\n[blue]------- ANTHC Heat Recovery Reporting Program -------\n')
+    rprint('[red]Red messages indicate an error that will stop report creation for that customer.')
+    rprint('[purple]Purple messages indicate an error that will cause missing information in the report.')
+    rprint('[green3]A Green message indicates a report was completed.\n')
+    if args.task != 'send':
+        # the 'send' task only needs the emails stored in the outbox
+        print('Acquiring data...\n')
+        with timing.span('sheets'):
+            if args.refresh_sheets:
+                util.data_util.sheet_values(max_age=0)
+            cust_recs = util.data_util.customer_records()
+
+    if args.task is None:
+        task, target_customers, year, month = prompt_for_run(cust_recs)
+    elif args.task == 'send':
+        task, target_customers = args.task, []
+        year, month = prior_month()
+    else:
+        task = args.task
+        target_customers = select_customers(cust_recs, args.city, args.customer, args.sensor_id)
+        def_year, def_month = prior_month()
+        year = args.year or def_year
+        month = args.month or def_month
+
+    if args.from_month:
+        billing_months = month_range(args.from_month, args.to_month)
+    else:
+        billing_months = [(year, month)]
+    if args.task in ('create', 'email'):
+        first, last = billing_months[0], billing_months[-1]
+        print(f"Task: {task}, Billing Months: {first[0]}-{first[1]:02d} through {last[0]}-{last[1]:02d}, "
+              f"Customers: {len(target_customers)}")
 
-                    # retrieve summary results for this customer's report for the billing month
+    # Make sure the output directory for reports exists.
+    report_folder = Path(args.output or config.report_folder)
+    try:
+        report_folder.mkdir(parents=True, exist_ok=True)
+    except:
+        rprint(f"[red]Error creating the Report directory:[/red]\n{report_folder}")
+
+    # Open the database that holds the summary results from each report created,
+    # which also holds the outbox of emails.
+    results = results_store.open_results(report_folder)
+    email_outbox.create_table(results)
+
+    if task == 'create':
+        # Fuel prices are only needed to create reports.
+        with timing.span('sheets'):
+            util_fuel_prices = util.data_util.utility_fuel_prices()
+        with timing.span('akwarm'):
+            akwarm_city_data, akwarm_lib_version = util.data_util.akwarm_city_data()
+        #from pickle import dump, load
+        #dump( (util_fuel_prices, akwarm_city_data), open('data.pkl', 'wb'))
+        #util_fuel_prices, akwarm_city_data = load(open('data.pkl', 'rb'))
+
+        if args.dry_run:
+            for customer in target_customers:
+                for year, month in billing_months:
                     report_fn = make_report_file_name(customer['customer'], customer['city'], year, month)
-                    cr = results[report_fn]
-
-                    invoice.send_invoice.send_email(
-                        to_addresses = [cust.strip() for cust in customer['cust_email'].split(',')],
-                        to_cc = [addr.strip() for addr in customer['anthc_emails'].split(',')],
-                        to_bcc = [],
-                        billing_period_start = cr['bill_start'],
-                        billing_period_end = cr['bill_end'],
-                        gal_saved = cr['gal_saved'],
-                        fuel_value = cr['gal_saved'] * cr['cust_price'],
-                        pdf_file_name = str(report_folder / report_fn),
-                    )
-                    rprint('[green3]Email sent!')
-
-                else:
-                    rprint('[red]No recipients listed in the customer spreadsheet.')
-                
-
-        except BaseException as err:
-            rprint(f"[red]Error: {err}")
-            #raise err
-
-        finally:
-            if task == 'create':
-                # Update the pickle file on disk holding report results
-                try:
-                    with open(results_path, 'wb') as results_fh:
-                        pickle.dump(results, results_fh)
-                except:
-                    rprint('[red]Error saving summary results information to disk.')
+                    print(f"Would create {report_fn} from sensor {customer['sensor_id']}")
+        else:
+            import util.heat_calcs
+            from util import reading_cache, monthly_rollups
+            sensor_ids = [cust['sensor_id'] for cust in target_customers if not cust['sensor_id'].startswith('test-')]
+            if args.refresh_readings:
+                for sensor_id in sensor_ids:
+                    reading_cache.invalidate(sensor_id)
+                    monthly_rollups.invalidate(sensor_id)
+
+            # Download the BMON readings for all the customers before creating reports.
+            print('Downloading BMON sensor readings...')
+            start_date, _ = util.heat_calcs.reading_window(*billing_months[0])
+            _, end_date = util.heat_calcs.reading_window(*billing_months[-1])
+            download_start = datetime.now()
+            with timing.span('download'):
+                errors = reading_cache.prefetch(config.bmon_url, sensor_ids, start_date, end_date, 
+                                                max_threads=args.download_threads)
+            for sensor_id, err in errors.items():
+                rprint(f"[purple]Error downloading readings for sensor {sensor_id}: {err}")
+
+            # The reports use the readings just downloaded without contacting BMON again;
+            # sensors that failed to download are retried when their reports are created.
+            reading_cache.fresh_since = download_start
+
+            pages = [] if (args.combined or args.zip) else None
+            create_reports(target_customers, billing_months, akwarm_city_data, util_fuel_prices,
+                           report_folder, results, workers=args.workers, pages=pages, fleet=args.fleet,
+                           stream=args.stream)
+            if pages:
+                write_bulk_reports(pages, billing_months, report_folder, args.combined, args.zip)
+
+    elif task == 'email':
+        email_reports(target_customers, billing_months, report_folder, results, dry_run=args.dry_run,
+                      resend=args.resend, queue_only=args.queue_only)
 
-    print()
\ No newline at end of file
+    else:
+        send_outbox(results)
+
+    if args.profile:
+        import pstats
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"\nProfile saved to {args.profile}; the functions taking the most time:")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if args.timing:
+        print()
+        rprint(timing.summary_table())
+    if args.timing_json:
+        timing.write_json(args.timing_json)
+
+    print()
@@ -1,20 +1,271 @@
 #!/usr/bin/env python
+"""Checks the gallon calculations in util.heat_calcs.get_gallon_data() against a
+reference implementation that uses Pandas resampling, for each of the test datasets
+in the 'test-data/' folder and each month of 2021.  Also checks sending emails in
+invoice.send_invoice against a fake mail server.
+"""
 from datetime import datetime
+from calendar import monthrange
+import smtplib
+import tempfile
+import time
 
-from util.heat_calcs import get_gallon_data, gallons_delivered
+import numpy as np
+import pandas as pd
 
-""" st = datetime(2021, 5, 1)
-end = datetime(2021, 7, 31)
+import config
+from util.heat_calcs import (get_gallon_data, reading_window, rollup_gallon_data, sensor_readings, 
+                              stream_gallon_data, reading_chunks, fleet_gallon_data)
+from util import monthly_rollups
+from util.synthetic import synthetic_readings
+from invoice import send_invoice
 
-print(str(st))
+TEST_SENSORS = ('clean_dataset', 'sensor_resets', 'missing_values', 'two_missing_months')
 
-df = get_gallon_data('test-clean_dataset', None, st, end)
+# A synthetic sensor with outages longer than a month, billed for each month of 2020 and
+# 2021 when checking the other ways of calculating get_gallon_data() results.
+OUTAGE_SENSOR = 'synthetic:interval=15,resets=6,gaps=3,gap_days=35,nan=0.2,seed=5'
 
-print(df.head())
-print(df.tail())
- """
+def reference_gallon_data(btu_sensor_id, btu_mult, bill_year, bill_month):
+    """Reference version of get_gallon_data() using Pandas resampling.
+    """
+    start_date, end_date = reading_window(bill_year, bill_month)
+    df = pd.read_pickle(f'test-data/{btu_sensor_id[5:]}.pkl', compression='bz2')
+    df = df.query('index >= @start_date and index <= @end_date').copy()
 
-df = gallons_delivered(2021, 3, 'test-sensor_resets')
-print(df.head())
-print(df.tail())
-print(df.change.sum())
\ No newline at end of file
+    df.columns = ['btus']
+    df['btus'] *= btu_mult
+    df['change'] = df.btus.diff()
+    df['change'] = df.change.where(df.change >= 0.0)
+    df['gallons'] = df.change / (config.oil_btu_content * config.oil_heating_effic)
+    df['ts'] = pd.to_datetime(df.index).values
+    df['prior_ts'] = df.ts.shift(1)
+    df.drop(columns=['btus', 'change'], inplace=True)
+
+    df_mo = df.resample('M').agg({'gallons': sum, 'ts': 'max', 'prior_ts': 'min'})
+    df_mo['bill_days'] = (df_mo.ts - df_mo.prior_ts).dt.total_seconds() / (3600 * 24)
+    df_mo['full_month_err'] = df_mo.bill_days - df_mo.index.days_in_month
+    df_mo = df_mo.query('index < @end_date').copy()
+    new_ix = pd.date_range(end=df_mo.index[-1], freq='M', periods=12)
+    df_mo = df_mo.reindex(new_ix)
+
+    df_billed_mo = df[(df.index.year == bill_year) & (df.index.month == bill_month)]
+    df_daily = df_billed_mo.resample('D').agg({'gallons': sum, 'ts': 'max', 'prior_ts': 'min'})
+    df_daily['bill_days'] = (df_daily.ts - df_daily.prior_ts).dt.total_seconds() / (3600 * 24)
+    df_daily.drop(columns=['ts', 'prior_ts'], inplace=True)
+    st = datetime(bill_year, bill_month, 1)
+    _, days_in_month = monthrange(bill_year, bill_month)
+    new_ix = pd.date_range(start=st, freq='D', periods=days_in_month)
+    df_daily = df_daily.reindex(new_ix)
+
+    return df_mo, df_daily
+
+def check_gallon_data():
+    """Compares get_gallon_data() to reference_gallon_data().  Returns the number of
+    failures.
+    """
+    failures = 0
+    for sensor in TEST_SENSORS:
+        for month in range(1, 13):
+            sensor_id = f'test-{sensor}'
+            df_mo, df_daily = get_gallon_data(sensor_id, 1.5, None, 2021, month)
+            ref_mo, ref_daily = reference_gallon_data(sensor_id, 1.5, 2021, month)
+            try:
+                # sums may differ in the last bits due to the order of summation
+                pd.testing.assert_frame_equal(df_mo, ref_mo, check_exact=False, rtol=1e-12)
+                pd.testing.assert_frame_equal(df_daily, ref_daily, check_exact=False, rtol=1e-12)
+            except AssertionError as err:
+                failures += 1
+                print(f'{sensor_id} 2021-{month:02d}: {err}')
+    return failures
+
+def check_synthetic_windows():
+    """Checks that synthetic meters give the same readings in the overlap of two ranges
+    of readings: the same reading times, NaN values and BTUs between readings (see
+    util.synthetic).  Returns the number of failures.
+    """
+    failures = 0
+    overlap_start, overlap_end = np.datetime64('2020-01-01'), np.datetime64('2020-07-01')
+    for seed in range(20):
+        settings = dict(interval=60, resets=2, gaps=3, gap_days=35, nan=0.01, drop=0.05, seed=seed)
+        ts_a, btus_a = synthetic_readings(datetime(2019, 11, 1), datetime(2020, 6, 30, 23), **settings)
+        ts_b, btus_b = synthetic_readings(datetime(2020, 1, 1), datetime(2020, 12, 31, 23), **settings)
+        in_a = (ts_a >= overlap_start) & (ts_a < overlap_end)
+        in_b = (ts_b >= overlap_start) & (ts_b < overlap_end)
+        if not np.array_equal(ts_a[in_a], ts_b[in_b]):
+            failures += 1
+            print(f'synthetic seed {seed}: reading times differ between ranges')
+            continue
+        btus_a, btus_b = btus_a[in_a], btus_b[in_b]
+        # the counts differ by the starting count, except across resets
+        change_a, change_b = np.diff(btus_a), np.diff(btus_b)
+        counted = (change_a >= 0.0) & (change_b >= 0.0)
+        if not (np.array_equal(np.isnan(btus_a), np.isnan(btus_b)) 
+                and np.allclose(change_a[counted], change_b[counted], rtol=1e-9)):
+            failures += 1
+            print(f'synthetic seed {seed}: readings differ between ranges')
+    return failures
+
+def check_gallon_paths():
+    """Compares the results of rollup_gallon_data() with an empty and with a filled store
+    of monthly totals, stream_gallon_data() and fleet_gallon_data() to those of 
+    get_gallon_data(), for each test dataset.  Returns the number of failures.
+    """
+    sensors = {f'test-{sensor}': [(2021, month) for month in range(1, 13)] for sensor in TEST_SENSORS}
+    sensors[f'test-{OUTAGE_SENSOR}'] = [(year, month) for year in (2020, 2021) for month in range(1, 13)]
+
+    failures = 0
+    def compare(label, sensor_id, year, month, expected, calc):
+        nonlocal failures
+        try:
+            # sums may differ in the last bits due to the order of summation
+            result = calc()
+            if expected is None:
+                raise AssertionError('get_gallon_data() found no readings')
+            for df, df_expected in zip(result, expected):
+                pd.testing.assert_frame_equal(df, df_expected, check_exact=False, rtol=1e-12)
+        except (AssertionError, IndexError, KeyError) as err:
+            if expected is not None or not isinstance(err, (IndexError, KeyError)):
+                failures += 1
+                print(f'{label} {sensor_id} {year}-{month:02d}: {err!r}')
+
+    for sensor_id, months in sensors.items():
+        for year, month in months:
+            try:
+                expected = get_gallon_data(sensor_id, 1.5, None, year, month)
+            except IndexError:
+                expected = None    # no readings before the end of the billing month
+            start_date, end_date = reading_window(year, month)
+
+            monthly_rollups.invalidate(sensor_id)
+            compare('rollup (empty store)', sensor_id, year, month, expected,
+                    lambda: rollup_gallon_data(sensor_id, 1.5, None, year, month))
+            compare('stream', sensor_id, year, month, expected,
+                    lambda: stream_gallon_data(reading_chunks(sensor_id, None, start_date, end_date, 1000), 
+                                               1.5, year, month))
+            df = sensor_readings(sensor_id, None, start_date, end_date)
+            compare('fleet', sensor_id, year, month, expected,
+                    lambda: fleet_gallon_data({sensor_id: (df, 1.5)}, year, month)[sensor_id])
+
+        # bill every month to fill the store, then again from the filled store
+        for year, month in months:
+            rollup_gallon_data(sensor_id, 1.5, None, year, month)
+        for year, month in months:
+            try:
+                expected = get_gallon_data(sensor_id, 1.5, None, year, month)
+            except IndexError:
+                expected = None
+            compare('rollup (filled store)', sensor_id, year, month, expected,
+                    lambda: rollup_gallon_data(sensor_id, 1.5, None, year, month))
+
+    return failures
+
+class FakeSender:
+    """Stands in for a yagmail sender and its SMTP connection.  'errors' are raised by
+    successive sendmail() calls; a None sends the email.
+    """
+    def __init__(self, errors=()):
+        self.user = 'sender@example.com'
+        self.smtp = self
+        self.errors = list(errors)
+        self.logins = 0
+        self.closes = 0
+        self.attempts = 0
+        self.sent = []
+
+    def prepare_send(self, to, attachments, **kwargs):
+        return to, b'message\nbody'
+
+    def login(self):
+        self.logins += 1
+
+    def close(self):
+        self.closes += 1
+
+    def sendmail(self, user, recipients, msg_bytes):
+        self.attempts += 1
+        err = self.errors.pop(0) if self.errors else None
+        if err is not None:
+            raise err
+        self.sent.append(recipients)
+
+def check_email_sending():
+    """Checks the throttle, the classification of SMTP errors, and the retries and
+    reconnections of pooled senders, using FakeSender.  Returns the number of failures.
+    """
+    failures = 0
+    def check(ok, description):
+        nonlocal failures
+        if not ok:
+            failures += 1
+            print(f'email: {description}')
+
+    # the throttle spaces out sends, and does nothing without a limit
+    throttle = send_invoice._Throttle(600)
+    start = time.monotonic()
+    for _ in range(4):
+        throttle.wait()
+    check(time.monotonic() - start >= 0.3, '_Throttle(600) allowed 4 sends in under 0.3 s')
+    throttle = send_invoice._Throttle(None)
+    start = time.monotonic()
+    for _ in range(100):
+        throttle.wait()
+    check(time.monotonic() - start < 0.1, '_Throttle(None) delayed sends')
+
+    cases = [
+        (smtplib.SMTPServerDisconnected('lost'), True),
+        (smtplib.SMTPResponseException(421, b'busy'), True),
+        (smtplib.SMTPResponseException(550, b'no such user'), False),
+        (smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'busy')}), True),
+        (smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'busy'), 'b@example.com': (550, b'no')}), False),
+        (smtplib.SMTPNotSupportedError('no AUTH'), False),
+        (ConnectionResetError(), True),
+        (ValueError(), False),
+    ]
+    for err, temporary in cases:
+        check(send_invoice._is_temporary(err) == temporary, f'_is_temporary({err!r}) is not {temporary}')
+
+    make_sender, retry_delay = send_invoice.make_sender, send_invoice.SEND_RETRY_DELAY
+    send_invoice.SEND_RETRY_DELAY = 0.0
+    email = dict(to=['a@example.com'], attachments='report.pdf')
+    try:
+        # a lost connection is retried on a new connection
+        fake = FakeSender([smtplib.SMTPServerDisconnected('lost')])
+        send_invoice.make_sender = lambda: fake
+        send_invoice._PooledSender().send(email, send_invoice._Throttle(None))
+        check((fake.logins, fake.closes, len(fake.sent)) == (2, 1, 1), 'lost connection was not retried')
+
+        # a permanent failure is not retried
+        fake = FakeSender([smtplib.SMTPResponseException(550, b'no such user')])
+        try:
+            send_invoice._PooledSender().send(email, send_invoice._Throttle(None))
+            check(False, 'permanent failure was not raised')
+        except smtplib.SMTPResponseException:
+            check(fake.attempts == 1, 'permanent failure was retried')
+
+        # temporary failures are retried SEND_RETRIES times
+        fake = FakeSender([smtplib.SMTPResponseException(421, b'busy')] * (send_invoice.SEND_RETRIES + 1))
+        try:
+            send_invoice._PooledSender().send(email, send_invoice._Throttle(None))
+            check(False, 'repeated temporary failure was not raised')
+        except smtplib.SMTPResponseException:
+            check(fake.attempts == send_invoice.SEND_RETRIES + 1, 'wrong number of retries')
+
+        # a batch over one connection logs in once, again after a lost connection, and
+        # closes the connection at the end
+        fake = FakeSender([None, smtplib.SMTPServerDisconnected('lost')])
+        emails = [dict(to=[f'c{i}@example.com'], attachments=f'report{i}.pdf') for i in range(5)]
+        results = list(send_invoice.send_emails(emails, connections=1, max_per_minute=None))
+        check(all(err is None for _, err in results) and len(fake.sent) == 5, 'batch emails were not all sent')
+        check((fake.logins, fake.closes) == (2, 2), 'batch did not reuse and reconnect its connection')
+    finally:
+        send_invoice.make_sender, send_invoice.SEND_RETRY_DELAY = make_sender, retry_delay
+
+    return failures
+
+if __name__ == '__main__':
+    # keep the stores made by the checks out of the cache folder
+    config.cache_folder = tempfile.mkdtemp()
+    failures = (check_gallon_data() + check_gallon_paths() + check_synthetic_windows() 
+                + check_email_sending())
+    print(f'{failures} failures')
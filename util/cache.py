@@ -0,0 +1,15 @@
+"""Location of the local cache of data downloaded from BMON, AkWarm and Google Sheets.
+"""
+from pathlib import Path
+
+import config
+
+
+def cache_path(*parts) -> Path:
+    """Returns the path to 'parts' (e.g. a subfolder and file name) within the local
+    cache folder, creating the containing folder if needed.  The cache folder is set by
+    'cache_folder' in the config file; it defaults to the 'cache' folder of this repository.
+    """
+    path = Path(getattr(config, 'cache_folder', 'cache')).joinpath(*parts)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
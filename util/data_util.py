@@ -1,17 +1,55 @@
 import math
-from io import BytesIO
-import gzip
+import pickle
+import time
+import zlib
 import xml.etree.ElementTree as ET
 
-import requests
-import gspread
-
 import config
+from util.cache import cache_path
+
+# Worksheets used from the Heat Recovery Billing spreadsheet on Google Sheets.
+CUSTOMER_SHEET = 'Customers'
+FUEL_PRICE_SHEET = 'Utility Fuel Prices'
+
+# Number of seconds that the local snapshot of the spreadsheet values is used before
+# the spreadsheet is read again.
+SHEET_SNAPSHOT_TTL = getattr(config, 'sheet_snapshot_ttl', 600)
 
-# Get a handle to the Heat Recovery Billing spreadsheet on Google Sheets.  Needed 
-# for a couple different data routines below.
-gc = gspread.service_account(filename=config.spreadsheet_creds_file)
-cust_wb = gc.open_by_key(config.spreadsheet_id)
+# Location of the AkWarm Energy Library files
+AKWARM_LIB_URL = 'https://analysisnorth.com/AkWarm/update_combined/'
+
+# Translation table that decodes the bytes of an AkWarm library file, which are
+# XOR'd with the value 30.
+AKWARM_DECODE_TABLE = bytes(x ^ 30 for x in range(256))
+
+def sheet_values(max_age=SHEET_SNAPSHOT_TTL):
+    """Returns a dictionary mapping worksheet name to the list of rows in that worksheet
+    for the worksheets used from the Heat Recovery Billing spreadsheet.  All worksheets
+    are read from Google Sheets in one request.  The values are saved in a snapshot in
+    the local cache folder, which is used instead of Google Sheets if it is less than
+    'max_age' seconds old.
+    """
+    snapshot_path = cache_path('sheets.pkl')
+    if snapshot_path.exists() and time.time() - snapshot_path.stat().st_mtime < max_age:
+        with open(snapshot_path, 'rb') as fh:
+            return pickle.load(fh)
+
+    import gspread
+    from gspread.utils import absolute_range_name, fill_gaps
+
+    gc = gspread.service_account(filename=config.spreadsheet_creds_file)
+    cust_wb = gc.open_by_key(config.spreadsheet_id)
+    sheet_names = (CUSTOMER_SHEET, FUEL_PRICE_SHEET)
+    resp = cust_wb.values_batch_get([absolute_range_name(name) for name in sheet_names])
+    values = {
+        name: fill_gaps(value_range.get('values', []))
+        for name, value_range in zip(sheet_names, resp['valueRanges'])
+    }
+
+    with open(snapshot_path, 'wb') as fh:
+        pickle.dump(values, fh)
+
+    return values
 
 def customer_records():
     """Returns a list of heat recovery customer records from the customer Google Sheet.
@@ -23,7 +61,7 @@ def customer_records():
         'cust_fuel_override', 'feas_g_01', 'feas_g_02', 'feas_g_03', 'feas_g_04', 'feas_g_05', 'feas_g_06', 
         'feas_g_07', 'feas_g_08', 'feas_g_09', 'feas_g_10', 'feas_g_11', 'feas_g_12')
 
-    rows = cust_wb.worksheet('Customers').get_all_values()
+    rows = sheet_values()[CUSTOMER_SHEET]
 
     # find row with column abbreviations and then make records from the rest of the rows
     recs = []
@@ -52,7 +90,7 @@ def utility_fuel_prices():
     """Returns a dictionary mapping utility fuel price category to an actual fuel price per gallon.
     Data comes from the Heat Recovery Billing spreadsheet.
     """
-    rows = cust_wb.worksheet('Utility Fuel Prices').get_all_values()
+    rows = sheet_values()[FUEL_PRICE_SHEET]
     prices = {}
     for row in rows[1:]:
         try:
@@ -62,30 +100,73 @@ def utility_fuel_prices():
 
     return prices
 
-def akwarm_lib_xml():
-    """Returns the root XML ElementTree of the most current AkWarm Energy Library.
-    Prints the name of that library.  Requires an Internet connection to retrieve
-    data online.
+def akwarm_lib_name():
+    """Returns the name of the most current AkWarm Energy Library, as listed in the
+    small library information file on the AkWarm update site.
     """
-    resp = requests.get('https://analysisnorth.com/AkWarm/update_combined/Library_Info.txt')
-    cur_lib_name = resp.text.splitlines()[-1].split('\t')[0]
-    resp = requests.get(f'https://analysisnorth.com/AkWarm/update_combined/{cur_lib_name}')
-    res = [ x ^ 30 for x in resp.content]
-    file_res = BytesIO(bytes(res))
-    del res   # to save memory
-    lib = gzip.GzipFile(mode='r', fileobj=file_res).read()
-    root = ET.fromstring(lib.decode('utf-8'))
-    return root, cur_lib_name
+    import requests
+
+    resp = requests.get(f'{AKWARM_LIB_URL}Library_Info.txt')
+    return resp.text.splitlines()[-1].split('\t')[0]
+
+def akwarm_city_array(lib_name=None):
+    """Returns the ArrayOfCity XML Element from the City table of the AkWarm Energy
+    Library named 'lib_name'.  If 'lib_name' is not provided, the most current library
+    is used.  Requires an Internet connection to retrieve data online.
+
+    The library is decoded, decompressed and parsed as it is downloaded.  Elements
+    of the other library tables are discarded once parsed, and the download stops
+    when the City table has been read.
+    """
+    import requests
+
+    lib_name = lib_name or akwarm_lib_name()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)    # gzip format
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    path = []           # elements from the root to the element being parsed
+    table_name = None   # name of the library table being parsed
+
+    with requests.get(f'{AKWARM_LIB_URL}{lib_name}', stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(chunk_size=2**16):
+            parser.feed(decompressor.decompress(chunk.translate(AKWARM_DECODE_TABLE)))
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    path.append(elem)
+                    continue
+
+                path.pop()
+                tags = [el.tag for el in path] + [elem.tag]
+                # The library is a list of items, each with a table name key and
+                # a table value: <item><key><string>..</string></key><value>..</value></item>
+                if tags[1:] == ['item', 'key', 'string']:
+                    table_name = elem.text
+                elif table_name == 'City' and tags[1:] == ['item', 'value', 'ArrayOfCity']:
+                    return elem
+                elif table_name != 'City' and len(tags) in (4, 5):
+                    # discard the table records, and the table once complete
+                    elem.clear()
+
+    raise ValueError(f'City table not found in AkWarm library {lib_name}.')
 
 def akwarm_city_data():
     """Returns a dictionary keyed on City Name with the dictionary value being a dictionary
     of key fields and values from the City table in the most recent AkWarm Energy Library.
-    Makes an attempt to convert the field value to a float.
+    Makes an attempt to convert the field value to a float.  Also returns the name of the
+    library.
+
+    The City table is stored in the local cache folder for each library, so the library
+    is only downloaded when a new version is released.
     """
-    root, lib_name = akwarm_lib_xml()
+    lib_name = akwarm_lib_name()
+    city_cache_path = cache_path('akwarm', f'{lib_name}.pkl')
+    if city_cache_path.exists():
+        with open(city_cache_path, 'rb') as fh:
+            return pickle.load(fh), lib_name
+
     city_data = {}
     targets = ('Oil1Price', 'Oil2Price')
-    cities = root.find("./item/key/string[.='City']/../../value/ArrayOfCity")
+    cities = akwarm_city_array(lib_name)
     for city in cities:
         fields = {}    
         for fld in targets:
@@ -97,6 +178,9 @@ def akwarm_city_data():
             fields[fld] = val
         city_data[city.find("Name").text] = fields
 
+    with open(city_cache_path, 'wb') as fh:
+        pickle.dump(city_data, fh)
+
     return city_data, lib_name
 
 def chgnan(val, nan_substitue):
@@ -0,0 +1,104 @@
+'''Module that keeps an outbox of the report emails, in the results database (see
+util.results_store), so that an interrupted or partly failed email run can be resumed
+without emailing anyone twice.
+
+Each report's email is queued as 'pending' and marked 'sent' or 'failed' when sending
+finishes.  An email keeps the same Message-ID when it is retried, so if it was actually
+delivered before a crash, the copy sent on the retry is recognizable as a duplicate.
+'''
+
+from datetime import datetime
+from email.utils import make_msgid
+import json
+
+import config
+
+# States of an email in the outbox
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS outbox (
+    report_fn TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    state TEXT NOT NULL CHECK (state IN ('{PENDING}', '{SENT}', '{FAILED}')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state);
+'''
+
+def create_table(conn):
+    """Creates the outbox table in the results database 'conn' if it does not exist.
+    """
+    with conn:
+        conn.executescript(_SCHEMA)
+
+def _row_to_dict(row):
+    """Returns a dictionary of the values in the 'row' from the outbox table, with the
+    email dictionary decoded.
+    """
+    rec = dict(row)
+    rec['email'] = json.loads(rec['email'])
+    return rec
+
+def get_entry(conn, report_fn):
+    """Returns a dictionary of the outbox entry for the report 'report_fn', or None if its
+    email has not been queued.
+    """
+    row = conn.execute('SELECT * FROM outbox WHERE report_fn = ?', (report_fn,)).fetchone()
+    return None if row is None else _row_to_dict(row)
+
+def queue_email(conn, report_fn, email):
+    """Queues the 'email' dictionary (see invoice.send_invoice.make_email()) for the report
+    'report_fn' as pending, replacing any email previously queued for the report.  An
+    email that has not been sent keeps its Message-ID; a new one is made for an email that
+    was already sent.  Returns the Message-ID.
+    """
+    entry = get_entry(conn, report_fn)
+    if entry is not None and entry['state'] != SENT:
+        message_id = entry['message_id']
+    else:
+        message_id = make_msgid(domain=config.email_user.split('@')[-1])
+    email = dict(email, message_id=message_id)
+    with conn:
+        conn.execute(
+            '''INSERT OR REPLACE INTO outbox (report_fn, email, message_id, state, attempts, error, updated)
+               VALUES (?, ?, ?, ?, ?, NULL, ?)''',
+            (report_fn, json.dumps(email), message_id, PENDING,
+             0 if entry is None else entry['attempts'], datetime.now().isoformat())
+        )
+    return message_id
+
+def unsent(conn, report_fns=None):
+    """Returns a list of the outbox entries that are pending or failed, ordered by report
+    file name.  If 'report_fns' is given, only entries for those reports are returned.
+    """
+    rows = conn.execute(
+        'SELECT * FROM outbox WHERE state IN (?, ?) ORDER BY report_fn', (PENDING, FAILED)
+    )
+    entries = [_row_to_dict(row) for row in rows]
+    if report_fns is not None:
+        report_fns = set(report_fns)
+        entries = [entry for entry in entries if entry['report_fn'] in report_fns]
+    return entries
+
+def _set_state(conn, report_fn, state, error=None):
+    with conn:
+        conn.execute(
+            'UPDATE outbox SET state = ?, attempts = attempts + 1, error = ?, updated = ? WHERE report_fn = ?',
+            (state, error, datetime.now().isoformat(), report_fn)
+        )
+
+def mark_sent(conn, report_fn):
+    """Records that the email for the report 'report_fn' was sent.
+    """
+    _set_state(conn, report_fn, SENT)
+
+def mark_failed(conn, report_fn, error):
+    """Records that sending the email for the report 'report_fn' failed with 'error'.
+    """
+    _set_state(conn, report_fn, FAILED, str(error))
@@ -4,23 +4,267 @@ period and check data quality.
 
 from datetime import datetime, timedelta
 from calendar import monthrange
-import io
 
 import pandas as pd
 import numpy as np
-import bmondata
-from matplotlib import pyplot as plt
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.dates as mdates
 from PIL import Image
 
 import config
+from util import monthly_rollups, reading_archive, reading_cache, synthetic, timing
 
 # Constant that controls whether a particular month's data is included in the
 # historical Monthly graph.  This is the largest acceptable deviation in 
 # billed days from the actual number of days in the month.
 MAX_BILL_DAY_ERR = 6.0 
 
-def get_gallon_data(btu_sensor_id, btu_mult, bmon_server_url, bill_year, bill_month):
+# Size in points of the spaces that the graphs fill on the report; see 
+# invoice.invoice_elements.build_graph_images().
+GRAPH_SLOT = (230, 140)
+
+# Size of the graphs in inches, with the same proportions as the report spaces, 
+# and the resolution they are drawn at: 2 pixels per point of the report space.
+GRAPH_SIZE = (4.4, 4.4 * GRAPH_SLOT[1] / GRAPH_SLOT[0])
+GRAPH_DPI = 2 * GRAPH_SLOT[0] / GRAPH_SIZE[0]
+
+# Matplotlib settings used to draw the graphs
+GRAPH_RC = {'font.size': 10}
+
+# The graph figures are created once for each process and reused for every report.
+_graphs = {}
+
+# Number of readings in each chunk when readings are processed a chunk at a time; see
+# stream_gallon_data().
+CHUNK_READINGS = getattr(config, 'stream_chunk_readings', 500_000)
+
+# Integer value of a NaT (missing) timestamp, in nanoseconds
+NAT = np.datetime64('NaT', 'ns').view('i8')
+
+# Groups with missing values are totaled again one at a time when there are no more
+# than this many of them; see _reduce_skipping().
+FEW_GROUPS = 32
+
+def _reduce_skipping(ufunc, values, starts, totals, is_missing, fill):
+    """Returns the 'totals' of the groups of 'values' starting at 'starts', as made by
+    'ufunc'.reduceat(), with the totals spoiled by a missing value made again with the
+    missing values replaced by 'fill'.  'is_missing' returns a boolean array marking the
+    missing values of an array.  Only the values of the affected groups are copied:
+    one group at a time if there are few of them (e.g. months), otherwise all at once,
+    or the full array if the groups are a large part of it.
+    """
+    groups = np.flatnonzero(is_missing(totals))
+    ends = np.append(starts[1:], len(values))
+    # reduceat() is used, rather than e.g. np.nansum(), so the values are combined in the
+    # same order as for the full array and the totals are identical.
+    if len(groups) <= FEW_GROUPS:
+        for i in groups:
+            group = values[starts[i]:ends[i]]
+            totals[i] = ufunc.reduceat(np.where(is_missing(group), fill, group), [0])[0]
+        return totals
+
+    lengths = ends[groups] - starts[groups]
+    if lengths.sum() > len(values) // 8:
+        return ufunc.reduceat(np.where(is_missing(values), fill, values), starts)
+
+    # gather the values of the affected groups into one array
+    sub_starts = np.cumsum(lengths) - lengths
+    sub = values[np.repeat(starts[groups] - sub_starts, lengths) + np.arange(lengths.sum())]
+    sub[is_missing(sub)] = fill
+    totals[groups] = ufunc.reduceat(sub, sub_starts)
+    return totals
+
+def _group_totals(keys, gallons, ts, prior_ts):
+    """Totals readings grouped by 'keys', a sorted, non-empty NumPy integer array giving
+    the group of each reading; see _aggregate() for the other arguments.  Returns a tuple
+    of NumPy arrays: the index of the first reading in each group, and for each group the
+    total gallons, the last reading timestamp and the earliest prior reading timestamp.
+    NaN gallons and NaT prior timestamps are ignored.
+    """
+    # the start of each group of readings with the same key
+    starts = np.append(0, np.flatnonzero(keys[1:] != keys[:-1]) + 1)
+    gal = _reduce_skipping(np.add, gallons, starts, np.add.reduceat(gallons, starts), np.isnan, 0.0)
+    ts_max = np.maximum.reduceat(ts, starts)
+    no_prior = np.iinfo(np.int64).max
+    prior_min = _reduce_skipping(np.minimum, prior_ts, starts, np.minimum.reduceat(prior_ts, starts), 
+                                 lambda arr: arr == NAT, no_prior)
+    prior_min[prior_min == no_prior] = NAT
+    return starts, gal, ts_max, prior_min
+
+def _bill_days(ts, prior_ts):
+    """Returns a NumPy array of the days between the integer nanosecond timestamps 'ts'
+    and 'prior_ts'; NaN where either is NaT.
+    """
+    elapsed = ts.ravel().view('datetime64[ns]') - prior_ts.ravel().view('datetime64[ns]')
+    days = pd.TimedeltaIndex(elapsed).total_seconds().to_numpy() / (3600 * 24)
+    return days.reshape(ts.shape)
+
+def _aggregate(periods, gallons, ts, prior_ts):
+    """Returns a DataFrame that totals readings into periods (months or days), like a Pandas
+    resample of the readings.  'periods' is a sorted NumPy datetime64 array of the period
+    (with unit 'M' or 'D') that each reading falls in.  'gallons' are the gallons for each
+    reading, 'ts' the timestamp of the reading and 'prior_ts' the timestamp of the prior
+    reading, both as integer nanoseconds.
+
+    The DataFrame is indexed on the period, labeled with its last day, and includes every
+    period from the first through the last reading.  Columns are the total gallons, the
+    last reading timestamp, the earliest prior reading timestamp and the days between
+    those timestamps ('bill_days').  NaN gallons and NaT prior timestamps are ignored.
+    """
+    if len(periods):
+        starts, gal, ts_max, prior_ts_min = _group_totals(periods.view('i8'), gallons, ts, prior_ts)
+        return _period_frame(periods[starts], gal, ts_max, prior_ts_min)
+    return _period_frame(periods, np.empty(0), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+def _period_frame(periods, gal, ts_max, prior_ts_min):
+    """Returns the DataFrame described in _aggregate() from the totals of the periods that
+    have readings.  'periods' is a sorted NumPy datetime64 array of those periods, and
+    'gal', 'ts_max' and 'prior_ts_min' are their totals, as returned by _group_totals().
+    """
+    unit = np.datetime_data(periods.dtype)[0]
+    if len(periods):
+        period_ix = (periods - periods[0]).view('i8')
+        n_periods = period_ix[-1] + 1
+
+        gal_all = np.zeros(n_periods)
+        gal_all[period_ix] = gal
+        ts_all = np.full(n_periods, NAT)
+        ts_all[period_ix] = ts_max
+        prior_all = np.full(n_periods, NAT)
+        prior_all[period_ix] = prior_ts_min
+        first_period = periods[0]
+    else:
+        gal_all = ts_all = prior_all = np.empty(0, dtype=np.int64)
+        first_period = np.datetime64(0, unit)
+        n_periods = 0
+
+    # label each period with its last day, as Pandas does for months
+    labels = (first_period + np.arange(1, n_periods + 1)).astype('datetime64[D]') - 1
+    df = pd.DataFrame(
+        {
+            'gallons': gal_all.astype(np.float64),
+            'ts': ts_all.view('datetime64[ns]'),
+            'prior_ts': prior_all.view('datetime64[ns]'),
+        },
+        index=pd.DatetimeIndex(labels.astype('datetime64[ns]'), freq='M' if unit == 'M' else 'D'),
+    )
+    df['bill_days'] = _bill_days(ts_all, prior_all)
+    return df
+
+def reading_window(bill_year, bill_month):
+    """Returns the start and end date/time of the sensor readings needed to bill
+    'bill_month' of 'bill_year': a full year prior to the start of the billing month
+    through a bit into the next month.
+    """
+    start_date = datetime(bill_year, bill_month, 1) - timedelta(days=365)
+    end_date = datetime(bill_year, bill_month, 1) + timedelta(days=31)
+    return start_date, end_date
+
+def sensor_readings(btu_sensor_id, bmon_server_url, start_date, end_date):
+    """Returns a Pandas DataFrame with one column holding the readings of the BTU sensor
+    'btu_sensor_id' from 'start_date' through 'end_date'.  The readings are retrieved 
+    from the BMON server pointed to by 'bmon_server_url'.
+
+    If 'btu_sensor_id' begins with 'test-' it is considered to be a test sensor, and
+    a test dataframe is returned from the 'test-data/' folder of this repository, by
+    way of util.reading_archive.  A Sensor ID beginning with 'test-synthetic' returns
+    generated readings instead; see util.synthetic.
+    """
+    if btu_sensor_id.startswith('test-synthetic'):
+        # requesting a synthetic sensor
+        df = synthetic.sensor_readings(btu_sensor_id[5:], start_date, end_date)
+
+    elif btu_sensor_id.startswith('test-'):
+        # requesting a test data sensor, which is read from the reading archive after the
+        # first use so the whole dataset is not decompressed for each request.
+        reading_archive.import_pickle(f'test-data/{btu_sensor_id[5:]}.pkl', btu_sensor_id)
+        df = reading_archive.archive_readings(btu_sensor_id, start_date, end_date)
+
+    else:
+        # get data from BMON, using readings stored locally where available
+        df = reading_cache.sensor_readings(bmon_server_url, btu_sensor_id, start_date, end_date)
+
+    return df
+
+def _reading_gallons(df, btu_mult):
+    """Returns NumPy arrays of the timestamps of the readings in the DataFrame 'df' (as
+    integer nanoseconds), the timestamps of the prior readings, and the gallons saved
+    since the prior reading, sorted by time.  'btu_mult' converts the readings into BTUs.
+    """
+    # Work with NumPy arrays of the BTU readings and their timestamps (as integer 
+    # nanoseconds), sorted by time.  The readings are used without copying them where
+    # they are already float64, and BTUs are only calculated if 'btu_mult' is not 1.
+    btus = df.iloc[:, 0].to_numpy(dtype=np.float64)
+    if btu_mult != 1.0:
+        btus = btus * btu_mult
+
+    # The timestamps are copied once, after a NaT, into one buffer.  The timestamp of
+    # the prior reading involved in each difference is then a view of the same buffer,
+    # shifted by one reading.
+    ts_buffer = np.empty(len(df) + 1, dtype=np.int64)
+    ts_buffer[0] = NAT
+    ts_buffer[1:] = df.index.values.astype('datetime64[ns]', copy=False).view('i8')
+    ts, prior_ts = ts_buffer[1:], ts_buffer[:-1]
+
+    # Calculate differences in the BTU count so that resets can be handled (by eliminating
+    # negative differences), and convert them in place to fuel oil gallon equivalents.
+    gallons = np.empty(len(btus))
+    gallons[:1] = np.nan
+    np.subtract(btus[1:], btus[:-1], out=gallons[1:])
+    gallons[~(gallons >= 0.0)] = np.nan
+    gallons /= config.oil_btu_content * config.oil_heating_effic
+
+    if not np.all(ts[1:] >= ts[:-1]):
+        order = np.argsort(ts, kind='stable')
+        ts, prior_ts, gallons = ts[order], prior_ts[order], gallons[order]
+
+    return ts, prior_ts, gallons
+
+def _month_slice(bill_year, bill_month, ts):
+    """Returns the slice of the sorted integer nanosecond timestamps 'ts' that falls in
+    the billing month.
+    """
+    bill_mo = np.datetime64(f'{bill_year}-{bill_month:02d}', 'M')
+    i_start, i_end = np.searchsorted(ts, [bill_mo.astype('datetime64[ns]').view('i8'), 
+                                          (bill_mo + 1).astype('datetime64[ns]').view('i8')])
+    return slice(i_start, i_end)
+
+def _daily_frame(bill_year, bill_month, ts, prior_ts, gallons):
+    """Returns the DataFrame of daily total gallons for the billing month, as returned by
+    get_gallon_data(), from the arrays returned by _reading_gallons().
+    """
+    sl = _month_slice(bill_year, bill_month, ts)
+    df_daily = _aggregate(ts[sl].view('datetime64[ns]').astype('datetime64[D]'), gallons[sl], ts[sl], prior_ts[sl])
+    return _finish_daily(bill_year, bill_month, df_daily)
+
+def _finish_daily(bill_year, bill_month, df_daily):
+    """Returns the DataFrame of daily totals for the billing month made by _aggregate() 
+    in the form returned by get_gallon_data().
+    """
+    df_daily.drop(columns=['ts', 'prior_ts'], inplace=True)
+    # reindex to cover every day of the month
+    st = datetime(bill_year, bill_month, 1)
+    _, days_in_month = monthrange(bill_year, bill_month)
+    new_ix = pd.date_range(start=st, freq='D', periods=days_in_month)
+    return df_daily.reindex(new_ix)
+
+def _finish_monthly(bill_year, bill_month, df_mo):
+    """Returns the DataFrame of monthly totals made by _aggregate() from the readings in
+    the reading window in the form returned by get_gallon_data().
+    """
+    _, end_date = reading_window(bill_year, bill_month)
+
+    # the difference between the billed number of days and the days in the month
+    df_mo['full_month_err'] = df_mo.bill_days - df_mo.index.days_in_month
+    # trim it back to the billing month and before
+    df_mo = df_mo[df_mo.index < end_date]
+    # reindex to exactly 12 months, ending with the billing month
+    new_ix = pd.date_range(end=df_mo.index[-1], freq='M', periods=12)
+    return df_mo.reindex(new_ix)
+
+def get_gallon_data(btu_sensor_id, btu_mult, bmon_server_url, bill_year, bill_month, df_readings=None):
     """Returns two items in a tuple with information on gallons of oil saved 
     from use of recovered heat:
     Monthly Summary Pandas Dataframe that gives gallons saved and billing date range info
@@ -34,77 +278,403 @@ def get_gallon_data(btu_sensor_id, btu_mult, bmon_server_url, bill_year, bill_mo
 
     If 'sensor_id' begins with 'test-' it is considered to be a test sensor, and
     a test dataframe is returned from the 'test-data/' folder of this repository.
+
+    'df_readings' can be used to supply the sensor readings (as returned by
+    sensor_readings()) instead of retrieving them, for example when billing several
+    months from one set of readings.  It must cover the period given by reading_window().
     """
 
     # get sensor readings a full year prior to start of billing month through readings
     # a bit into the next month.
-    start_date = datetime(bill_year, bill_month, 1) - timedelta(days=365)
-    end_date = datetime(bill_year, bill_month, 1) + timedelta(days=31)
-
-    if btu_sensor_id.startswith('test-'):
-        # requesting a test data sensor
-        df = pd.read_pickle(f'test-data/{btu_sensor_id[5:]}.pkl', compression='bz2')
-        df = df.query('index >= @start_date and index <= @end_date').copy()
+    start_date, end_date = reading_window(bill_year, bill_month)
 
+    if df_readings is None:
+        df = sensor_readings(btu_sensor_id, bmon_server_url, start_date, end_date)
     else:
-        # get data from BMON
-        server = bmondata.Server(bmon_server_url)
-        df = server.sensor_readings(btu_sensor_id, str(start_date), str(end_date))
+        df = df_readings.loc[start_date:end_date]
 
-    df.columns = ['btus']
-    df['btus'] *= btu_mult
-
-    # Calculate differences in the BTU count so that resets can be handled (by eliminating
-    # negative differences).
-    df['change'] = df.btus.diff()
-    df['change'] = df.change.where(df.change >= 0.0)
-
-    # add a column for fuel oil gallon equivalents
-    df['gallons'] = df.change / (config.oil_btu_content * config.oil_heating_effic)
-
-    # gives a column that gives the timestamp of the prior reading that was involved
-    # in the difference.
-    df['ts'] = pd.to_datetime(df.index).values
-    df['prior_ts'] = df.ts.shift(1)
-
-    # No longer need btus and change columns
-    df.drop(columns=['btus', 'change'], inplace=True)
+    return _gallon_frames(bill_year, bill_month, *_reading_gallons(df, btu_mult))
 
+def _gallon_frames(bill_year, bill_month, ts, prior_ts, gallons):
+    """Returns the monthly and daily DataFrames returned by get_gallon_data() from the
+    arrays returned by _reading_gallons() for the readings of the reading window.
+    """
     # Create a Dataframe with monthly aggregated data
-    df_mo = df.resample('M').agg({'gallons': sum, 'ts': 'max', 'prior_ts': 'min'})
-    # billing days in the month total
-    df_mo['bill_days'] = (df_mo.ts - df_mo.prior_ts).dt.total_seconds() / (3600 * 24)
-    # the difference between the billed number of days and the days in the month
-    df_mo['full_month_err'] = df_mo.bill_days - df_mo.index.days_in_month
-    # trim it back to the billing month and before
-    df_mo = df_mo.query('index < @end_date').copy()
-    # reindex to exactly 12 months, ending with the billing month
-    new_ix = pd.date_range(end=df_mo.index[-1], freq='M', periods=12)
-    df_mo = df_mo.reindex(new_ix)
+    df_mo = _aggregate(ts.view('datetime64[ns]').astype('datetime64[M]'), gallons, ts, prior_ts)
 
     # Create a Pandas Dataframe that gives daily total gallons for the one month that
     # is being billed.
-    df_billed_mo = df[(df.index.year == bill_year) & (df.index.month == bill_month)]
-    df_daily = df_billed_mo.resample('D').agg({'gallons': sum, 'ts': 'max', 'prior_ts': 'min'})
-    df_daily['bill_days'] = (df_daily.ts - df_daily.prior_ts).dt.total_seconds() / (3600 * 24)
-    df_daily.drop(columns=['ts', 'prior_ts'], inplace=True)
-    # reindex to cover every day of the month
-    st = datetime(bill_year, bill_month, 1)
-    _, days_in_month = monthrange(bill_year, bill_month)
-    new_ix = pd.date_range(start=st, freq='D', periods=days_in_month)
-    df_daily = df_daily.reindex(new_ix)
+    df_daily = _daily_frame(bill_year, bill_month, ts, prior_ts, gallons)
 
-    return df_mo, df_daily
+    return _finish_monthly(bill_year, bill_month, df_mo), df_daily
 
-def mpl_to_image():
-    """Returns the current Matplotlib figure as a PIL image.
+def rollup_gallon_data(btu_sensor_id, btu_mult, bmon_server_url, bill_year, bill_month, df_readings=None):
+    """Returns the same results as get_gallon_data() (see it for the arguments), using the
+    monthly totals stored for the sensor (see util.monthly_rollups) for the 11 months
+    before the billing month.  When those are all stored, only the readings from the 
+    last reading before the billing month onward are used; otherwise the full year of
+    readings is used and the closed months found in it are stored for later use.
+    Readings are retrieved and totaled within 'load' and 'aggregate' timing spans.
+    """
+    start_date, end_date = reading_window(bill_year, bill_month)
+    gal_factor = btu_mult / (config.oil_btu_content * config.oil_heating_effic)
+    bill_mo = np.datetime64(f'{bill_year}-{bill_month:02d}', 'M')
+
+    def readings(start_date):
+        if df_readings is not None:
+            return df_readings.loc[start_date:end_date]
+        with timing.span('load'):
+            return sensor_readings(btu_sensor_id, bmon_server_url, start_date, end_date)
+
+    def closed_months(ts, prior_ts, gallons, first_month, last_month):
+        """Returns the monthly totals (ROLLUP_DTYPE array) of the months with readings
+        after 'first_month' and before 'last_month' (integer months).
+        """
+        months = ts.view('datetime64[ns]').astype('datetime64[M]').view('i8')
+        keep = (months > first_month) & (months < last_month)
+        if not keep.any():
+            return np.empty(0, dtype=monthly_rollups.ROLLUP_DTYPE)
+        starts, gal, ts_max, prior_min = _group_totals(months[keep], gallons[keep], ts[keep], prior_ts[keep])
+        rollups = np.empty(len(starts), dtype=monthly_rollups.ROLLUP_DTYPE)
+        rollups['month'] = months[keep][starts]
+        rollups['gallons'], rollups['ts'], rollups['prior_ts'] = gal, ts_max, prior_min
+        return rollups
+
+    stored = monthly_rollups.load_rollups(btu_sensor_id, gal_factor)
+    prior_months = np.arange(-11, 0) + bill_mo.view('i8')
+    stored = stored[np.isin(stored['month'], prior_months)]
+    # The prior reading of the first month was stored from an earlier reading window; if
+    # it is before this window (e.g. after an outage), get_gallon_data() would not see it,
+    # so the totals are calculated from the readings instead.
+    if len(stored) == len(prior_months) and stored['prior_ts'][0] >= pd.Timestamp(start_date).value:
+        # readings from the last reading of the month before the billing month
+        df = readings(pd.Timestamp(stored['ts'][-1]).to_pydatetime())
+        with timing.span('aggregate'):
+            ts, prior_ts, gallons = _reading_gallons(df, btu_mult)
+            if len(ts) and ts[-1] >= bill_mo.astype('datetime64[ns]').view('i8'):
+                # totals for the billing month
+                sl = _month_slice(bill_year, bill_month, ts)
+                if sl.stop > sl.start:
+                    _, gal, ts_max, prior_min = _group_totals(np.zeros(sl.stop - sl.start, dtype=np.int64), 
+                                                              gallons[sl], ts[sl], prior_ts[sl])
+                else:
+                    gal, ts_max, prior_min = np.zeros(1), np.full(1, NAT), np.full(1, NAT)
+                mo_gal = np.append(stored['gallons'], gal)
+                mo_ts = np.append(stored['ts'], ts_max)
+                mo_prior = np.append(stored['prior_ts'], prior_min)
+                bill_days = _bill_days(mo_ts, mo_prior)
+                df_mo = pd.DataFrame(
+                    {
+                        'gallons': mo_gal,
+                        'ts': mo_ts.view('datetime64[ns]'),
+                        'prior_ts': mo_prior.view('datetime64[ns]'),
+                        'bill_days': bill_days,
+                    },
+                    index=pd.date_range(end=datetime(bill_year, bill_month, monthrange(bill_year, bill_month)[1]), 
+                                         freq='M', periods=12),
+                )
+                df_mo['full_month_err'] = df_mo.bill_days - df_mo.index.days_in_month
+
+                # store the billing month once there are readings after it
+                if sl.stop < len(ts):
+                    monthly_rollups.save_rollups(btu_sensor_id, gal_factor,
+                        closed_months(ts, prior_ts, gallons, bill_mo.view('i8') - 1, bill_mo.view('i8') + 1))
+
+                return df_mo, _daily_frame(bill_year, bill_month, ts, prior_ts, gallons)
+
+    # The stored totals are not sufficient, or there are no readings in or after the
+    # billing month: calculate from the full set of readings.
+    df = readings(start_date)
+    with timing.span('aggregate'):
+        ts, prior_ts, gallons = _reading_gallons(df, btu_mult)
+        result = _gallon_frames(bill_year, bill_month, ts, prior_ts, gallons)
+        if len(ts):
+            months = ts[[0, -1]].view('datetime64[ns]').astype('datetime64[M]').view('i8')
+            monthly_rollups.save_rollups(btu_sensor_id, gal_factor, 
+                                         closed_months(ts, prior_ts, gallons, months[0], months[1]))
+    return result
+
+def reading_chunks(btu_sensor_id, bmon_server_url, start_date, end_date, chunk_size=CHUNK_READINGS):
+    """Yields the readings of the BTU sensor 'btu_sensor_id' from 'start_date' through
+    'end_date' in time order, as a series of (timestamps, values) tuples of NumPy arrays
+    holding at most 'chunk_size' readings, with the timestamps as integer nanoseconds.
+
+    BMON readings are read a chunk at a time from the local store (see util.reading_cache),
+    which is not updated here; main.py downloads the readings for all customers before
+    creating reports.  Test sensors are read a chunk at a time from the reading archive,
+    except synthetic sensors, which are generated in full and then split into chunks.
     """
-    buf = io.BytesIO()
-    plt.savefig(buf)
-    buf.seek(0)
-    return Image.open(buf)
+    if btu_sensor_id.startswith('test-synthetic'):
+        df = synthetic.sensor_readings(btu_sensor_id[5:], start_date, end_date)
+        ts, values = df.index.values.view('i8'), df.iloc[:, 0].to_numpy()
+        for i in range(0, len(ts), chunk_size):
+            yield ts[i:i + chunk_size], values[i:i + chunk_size]
+
+    elif btu_sensor_id.startswith('test-'):
+        reading_archive.import_pickle(f'test-data/{btu_sensor_id[5:]}.pkl', btu_sensor_id)
+        yield from reading_archive.archive_chunks(btu_sensor_id, start_date, end_date, chunk_size)
 
-def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_gallons):
+    else:
+        yield from reading_cache.stored_chunks(btu_sensor_id, start_date, end_date, chunk_size)
+
+def stream_gallon_data(chunks, btu_mult, bill_year, bill_month):
+    """Returns the same results as get_gallon_data() from the readings supplied in 
+    'chunks', an iterable of (timestamps, values) tuples of NumPy arrays in time order, 
+    e.g. from reading_chunks().  'btu_mult', 'bill_year' and 'bill_month' are as in 
+    get_gallon_data().  Readings outside reading_window() are ignored.
+
+    Each chunk is converted to gallons and totaled by month, and by day of the billing
+    month, as it arrives; the last reading of a chunk is carried into the next for the
+    difference and reset handling.  Memory use therefore depends on the chunk size
+    rather than on the number of readings.  Because the sums are split across chunks,
+    totals can differ from get_gallon_data() in the last digits.
+    """
+    start_date, end_date = reading_window(bill_year, bill_month)
+    start_ns, end_ns = pd.Timestamp(start_date).value, pd.Timestamp(end_date).value
+    bill_mo = np.datetime64(f'{bill_year}-{bill_month:02d}', 'M')
+    month_bounds = [bill_mo.astype('datetime64[ns]').view('i8'), (bill_mo + 1).astype('datetime64[ns]').view('i8')]
+
+    # totals of each chunk, by month and by day of the billing month
+    month_parts, day_parts = [], []
+    last_btus, last_ts = np.nan, NAT
+    for ts, values in chunks:
+        in_window = (ts >= start_ns) & (ts <= end_ns)
+        ts = ts[in_window]
+        if len(ts) == 0:
+            continue
+        if ts[0] < last_ts or np.any(ts[1:] < ts[:-1]):
+            raise ValueError('Readings must be supplied in time order.')
+        btus = values[in_window].astype(np.float64) * btu_mult
+
+        # differences in the BTU count from the prior reading, which may be in the prior
+        # chunk, eliminating negative differences due to resets
+        change = np.diff(btus, prepend=last_btus)
+        change[~(change >= 0.0)] = np.nan
+        gallons = change / (config.oil_btu_content * config.oil_heating_effic)
+        prior_ts = np.roll(ts, 1)
+        prior_ts[0] = last_ts
+        last_btus, last_ts = btus[-1], ts[-1]
+
+        months = ts.view('datetime64[ns]').astype('datetime64[M]')
+        starts, *totals = _group_totals(months.view('i8'), gallons, ts, prior_ts)
+        month_parts.append((months[starts], *totals))
+
+        i_start, i_end = np.searchsorted(ts, month_bounds)
+        if i_end > i_start:
+            sl = slice(i_start, i_end)
+            days = ts[sl].view('datetime64[ns]').astype('datetime64[D]')
+            starts, *totals = _group_totals(days.view('i8'), gallons[sl], ts[sl], prior_ts[sl])
+            day_parts.append((days[starts], *totals))
+
+    def combine(parts, unit):
+        """Returns the period DataFrame (see _aggregate()) from the totals of the chunks.
+        """
+        if not parts:
+            return _aggregate(np.empty(0, dtype=f'datetime64[{unit}]'), np.empty(0), 
+                              np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        periods, gal, ts_max, prior_min = (np.concatenate(arrays) for arrays in zip(*parts))
+        starts, *totals = _group_totals(periods.view('i8'), gal, ts_max, prior_min)
+        return _period_frame(periods[starts], *totals)
+
+    return (_finish_monthly(bill_year, bill_month, combine(month_parts, 'M')), 
+            _finish_daily(bill_year, bill_month, combine(day_parts, 'D')))
+
+def fleet_gallon_data(readings, bill_year, bill_month):
+    """Returns the get_gallon_data() results for many sensors at once, as a dictionary
+    mapping each key of 'readings' to a (monthly DataFrame, daily DataFrame) tuple.
+    'readings' maps a key (e.g. the Sensor ID) to a tuple of the sensor's readings, as
+    returned by sensor_readings() and covering the period given by reading_window(),
+    and its 'btu_mult'.  Sensors without readings before the end of the billing month
+    are left out of the results.
+
+    The readings of all the sensors are joined into one panel, and the reset handling,
+    gallon conversion and monthly and daily totals are done for the whole fleet in one
+    pass instead of once per sensor.
+    """
+    start_date, end_date = reading_window(bill_year, bill_month)
+
+    keys, frames = [], []
+    for key, (df, btu_mult) in readings.items():
+        df = df.loc[start_date:end_date]
+        if len(df):
+            keys.append(key)
+            frames.append((df, btu_mult))
+    if not keys:
+        return {}
+
+    # The panel: NumPy arrays of the sensor number, timestamp (as integer nanoseconds)
+    # and BTU count of every reading, in order by sensor.
+    lengths = np.array([len(df) for df, _ in frames])
+    sensor = np.repeat(np.arange(len(keys), dtype=np.int64), lengths)
+    btus = np.concatenate([df.iloc[:, 0].to_numpy(dtype=np.float64) for df, _ in frames])
+    btus *= np.repeat(np.array([btu_mult for _, btu_mult in frames], dtype=np.float64), lengths)
+    ts = np.concatenate([df.index.values.astype('datetime64[ns]').view('i8') for df, _ in frames])
+    # marks the first reading of each sensor, which has no prior reading
+    sensor_starts = np.cumsum(lengths) - lengths
+    first = np.zeros(len(ts), dtype=bool)
+    first[sensor_starts] = True
+
+    # Differences in the BTU count, eliminating negative differences due to resets,
+    # converted to fuel oil gallon equivalents.
+    change = np.diff(btus, prepend=np.nan)
+    change[first] = np.nan
+    change[~(change >= 0.0)] = np.nan
+    gallons = change / (config.oil_btu_content * config.oil_heating_effic)
+
+    # the timestamp of the prior reading that was involved in the difference.
+    prior_ts = np.roll(ts, 1)
+    prior_ts[first] = NAT
+
+    if not np.all((ts[1:] >= ts[:-1]) | first[1:]):
+        order = np.lexsort((ts, sensor))
+        ts, prior_ts, gallons = ts[order], prior_ts[order], gallons[order]
+
+    sensors = np.arange(len(keys))
+
+    def period_grid(periods, in_period, grid):
+        """Totals the readings where 'in_period' is True by sensor and period, where 
+        'periods' are the integer periods (months or days) of the readings.  Returns the
+        gallons, last reading timestamps and earliest prior reading timestamps as arrays
+        with a row for each sensor and a column for each period in the 'grid' array of
+        periods (one row per sensor).  As in get_gallon_data(), periods without readings
+        have 0 gallons between the first and last period with readings, NaN otherwise.
+        """
+        group_keys = (sensor[in_period] << 32) + periods[in_period]
+        gal = np.full(grid.shape, np.nan)
+        ts_max = np.full(grid.shape, NAT)
+        prior_min = np.full(grid.shape, NAT)
+        if len(group_keys) == 0:
+            return gal, ts_max, prior_min
+
+        starts, group_gal, group_ts, group_prior = _group_totals(group_keys, gallons[in_period], 
+                                                                 ts[in_period], prior_ts[in_period])
+        group_keys = group_keys[starts]
+        group_sensor = group_keys >> 32
+        group_period = group_keys - (group_sensor << 32)
+        first_ix = np.searchsorted(group_sensor, sensors, 'left')
+        last_ix = np.searchsorted(group_sensor, sensors, 'right') - 1
+        has_readings = (last_ix >= first_ix)[:, None]
+        first_period = group_period[np.minimum(first_ix, len(starts) - 1)][:, None]
+        last_period = group_period[np.maximum(last_ix, 0)][:, None]
+        in_range = has_readings & (grid >= first_period) & (grid <= last_period)
+
+        ix = np.minimum(np.searchsorted(group_keys, (sensors[:, None] << 32) + grid), len(starts) - 1)
+        found = group_keys[ix] == (sensors[:, None] << 32) + grid
+        gal[in_range] = 0.0
+        gal[found] = group_gal[ix[found]]
+        ts_max[found] = group_ts[ix[found]]
+        prior_min[found] = group_prior[ix[found]]
+        return gal, ts_max, prior_min
+
+    # Monthly totals for the 12 months ending with the last month that has readings
+    # and ends before the end of the reading window.
+    months = ts.view('datetime64[ns]').astype('datetime64[M]').view('i8')
+    first_month = np.minimum.reduceat(months, sensor_starts)
+    last_month = np.maximum.reduceat(months, sensor_starts)
+    end_month = (np.datetime64(end_date, 'ns') + np.timedelta64(1, 'D') - np.timedelta64(1, 'ns')
+                 ).astype('datetime64[M]').view('i8') - 1
+    last_month = np.minimum(last_month, end_month)
+    mo_grid = last_month[:, None] + np.arange(-11, 1)
+    mo_gal, mo_ts, mo_prior = period_grid(months, np.ones(len(ts), dtype=bool), mo_grid)
+    mo_bill_days = _bill_days(mo_ts, mo_prior)
+    # the months labeled with their last day, as get_gallon_data() does
+    mo_labels = (mo_grid.view('datetime64[M]') + 1).astype('datetime64[D]') - 1
+    days_in_month = (mo_labels - mo_grid.view('datetime64[M]').astype('datetime64[D]')).view('i8') + 1
+    mo_month_err = mo_bill_days - days_in_month
+
+    # Daily totals for the billing month
+    bill_mo = np.datetime64(f'{bill_year}-{bill_month:02d}', 'M')
+    month_days = np.arange(bill_mo.astype('datetime64[D]'), (bill_mo + 1).astype('datetime64[D]'))
+    days = ts.view('datetime64[ns]').astype('datetime64[D]').view('i8')
+    in_month = (days >= month_days[0].view('i8')) & (days <= month_days[-1].view('i8'))
+    day_grid = np.broadcast_to(month_days.view('i8'), (len(keys), len(month_days)))
+    day_gal, day_ts, day_prior = period_grid(days, in_month, day_grid)
+    day_bill_days = _bill_days(day_ts, day_prior)
+    day_index = pd.DatetimeIndex(month_days.astype('datetime64[ns]'), freq='D')
+
+    results = {}
+    mo_indexes = {}
+    for i, key in enumerate(keys):
+        if last_month[i] < first_month[i]:
+            # no readings before the end of the billing month
+            continue
+        if last_month[i] not in mo_indexes:
+            mo_indexes[last_month[i]] = pd.DatetimeIndex(mo_labels[i].astype('datetime64[ns]'), freq='M')
+        df_mo = pd.DataFrame(
+            {
+                'gallons': mo_gal[i],
+                'ts': mo_ts[i].view('datetime64[ns]'),
+                'prior_ts': mo_prior[i].view('datetime64[ns]'),
+                'bill_days': mo_bill_days[i],
+                'full_month_err': mo_month_err[i],
+            },
+            index=mo_indexes[last_month[i]],
+        )
+        df_daily = pd.DataFrame({'gallons': day_gal[i], 'bill_days': day_bill_days[i]}, index=day_index)
+        results[key] = (df_mo, df_daily)
+
+    return results
+
+def daily_graph():
+    """Returns the reusable figure for the graph of daily gallons saved in the billing
+    month, and its axes and lines: (figure, axes, gallons line, no data markers line).
+    """
+    if 'daily' not in _graphs:
+        with matplotlib.rc_context(GRAPH_RC):
+            fig = Figure(figsize=GRAPH_SIZE, dpi=GRAPH_DPI, layout='constrained')
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            ax.xaxis_date()
+            locator = mdates.AutoDateLocator()
+            ax.xaxis.set_major_locator(locator)
+            ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+            ax.margins(x=0)
+            gallons_line, = ax.plot([], [])
+            nan_line, = ax.plot([], [], 'bx', markersize=6)
+            ax.set_ylabel('gallons saved / day')
+        _graphs['daily'] = (fig, ax, gallons_line, nan_line)
+    return _graphs['daily']
+
+def history_graph():
+    """Returns the reusable figure for the graph of gallons saved in the last 12 months,
+    and its axes and artists: (figure, axes, bars, expected gallons line, no data markers line).
+    """
+    if 'history' not in _graphs:
+        with matplotlib.rc_context(GRAPH_RC):
+            fig = Figure(figsize=GRAPH_SIZE, dpi=GRAPH_DPI, layout='constrained')
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            x = np.arange(12)
+            bars = ax.bar(x, np.zeros(12), label='Actual')
+            expected_line, = ax.plot(x, np.zeros(12), 'ro--', label='Expected')
+            nan_line, = ax.plot(x, np.full(12, np.nan), 'bx', markersize=9)
+            ax.legend()
+            ax.set_xticks(x)
+            ax.set_ylabel('gallons saved / month')
+        _graphs['history'] = (fig, ax, bars, expected_line, nan_line)
+    return _graphs['history']
+
+def rescale(ax):
+    """Rescales the axes 'ax' to fit the current data, with the y axis starting at 0.
+    """
+    ax.relim()
+    ax.set_autoscale_on(True)
+    ax.autoscale_view()
+    ax.set_ylim(0, None)
+
+def mpl_to_image(fig):
+    """Returns the Matplotlib figure 'fig' as an RGB PIL image.  The image is made
+    directly from the pixels drawn by the Agg canvas rather than by saving and 
+    reloading an image file.
+    """
+    with matplotlib.rc_context(GRAPH_RC):
+        fig.canvas.draw()
+    image = Image.frombuffer('RGBA', fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    # converting makes a copy, so the image is unchanged when the figure is redrawn.
+    return image.convert('RGB')
+
+def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_gallons, df_readings=None,
+                      gallon_data=None):
     """Returns BTU billing information for the requested month and BTU meter sensor.
     'bill_month' is the month number (1 - 12) of the month to calculate.  'bill_year' 
     is the year of the billing month (e.g. 2022). 'btu_sensor_id' is the BMON Sensor
@@ -114,17 +684,28 @@ def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_g
     'expected_gallons' is a dictionary that maps month number to expected number
     saved gallons, for graphing purposes.
 
+    'df_readings' optionally supplies the sensor readings; see get_gallon_data().
+    'gallon_data' optionally supplies the get_gallon_data() results, e.g. from
+    fleet_gallon_data(), so they are not calculated again.
+
     Uses values from the config file to convert BTUs into oil gallons avoided.
 
     Returns a tuple:  oil gallons avoided, start of billing period (Python date/time), end of
-        billing period (Python datetime).
+        billing period (Python datetime), graph of the billing month, graph of the last 12 months.
+    """
+    if gallon_data is None:
+        with timing.span('aggregate'):
+            gallon_data = get_gallon_data(btu_sensor_id, btu_mult, config.bmon_url, bill_year, bill_month, df_readings)
+    df_mo, df_daily = gallon_data
+
+    with timing.span('chart'):
+        return billing_summary_graphs(bill_year, bill_month, df_mo, df_daily, expected_gallons)
+
+def billing_summary_graphs(bill_year, bill_month, df_mo, df_daily, expected_gallons):
+    """Returns the billing results for the month from the monthly and daily DataFrames
+    returned by get_gallon_data(); see gallons_delivered() for the arguments and the
+    tuple returned.
     """
-    df_mo, df_daily = get_gallon_data(btu_sensor_id, btu_mult, config.bmon_url, bill_year, bill_month)
-
-    # Set general graph properties
-    plt.rcParams['figure.constrained_layout.use'] = True
-    plt.rcParams['font.size'] = 10
-
     if df_daily.gallons.count() > 0:
         # pull the summary record for the requested billing month from the monthly
         # summary dataframe.
@@ -144,16 +725,12 @@ def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_g
         nan_vals = [max_plot_val * 0.025 if np.isnan(val) else np.nan for val in df_daily.gallons]
     
         # gallons avoided by day for the billing month.
-        plt.clf()
-        plt.figure(figsize=(4.4, 3.0))
-        df_daily.gallons.plot()
-        plt.plot(df_daily.index, nan_vals, 'bx', markersize=6)
-        plt.ylim(0, None)
-        plt.ylabel('gallons saved / day')
-        ax = plt.gca()
-        ax.xaxis.set_major_formatter(
-            mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
-        mo_graph_image = mpl_to_image()
+        fig, ax, gallons_line, nan_line = daily_graph()
+        x = mdates.date2num(df_daily.index)
+        gallons_line.set_data(x, df_daily.gallons.values)
+        nan_line.set_data(x, nan_vals)
+        rescale(ax)
+        mo_graph_image = mpl_to_image(fig)
 
     else:
         # no data for the requested billing month.
@@ -165,8 +742,6 @@ def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_g
 
     if df_mo.gallons.count() > 0:
         # There is some historical data.  Make a graph.
-        plt.clf()
-        plt.figure(figsize=(4.4, 3.0))
         # make the x labels, actual gallons saved and expected gallons for graphing.
         xlabels = []
         actual_gal = []
@@ -195,16 +770,14 @@ def gallons_delivered(bill_year, bill_month, btu_sensor_id, btu_mult, expected_g
         # scale up the nan_vals series to sit a bit above the axis
         for ix, val in enumerate(nan_vals):
             nan_vals[ix] = nan_vals[ix] * max_plot_val * 0.04
-        plt.bar(xlabels, actual_gal, label='Actual')
-        plt.plot(xlabels, expected_gal, 'ro--', label='Expected')
-        plt.plot(xlabels, nan_vals, 'bx', markersize=9)
-        plt.legend()
-        ax = plt.gca()
-        for label in ax.get_xticklabels(which='major'):
-            label.set(rotation=45, horizontalalignment='right')
-        plt.ylim(0, None)
-        plt.ylabel('gallons saved / month')
-        hist_graph_image = mpl_to_image()
+        fig, ax, bars, expected_line, nan_line = history_graph()
+        for bar, gal in zip(bars, actual_gal):
+            bar.set_height(0.0 if np.isnan(gal) else gal)
+        expected_line.set_ydata(expected_gal)
+        nan_line.set_ydata(nan_vals)
+        ax.set_xticklabels(xlabels, rotation=45, horizontalalignment='right')
+        rescale(ax)
+        hist_graph_image = mpl_to_image(fig)
 
     else:
         hist_graph_image = Image.open('images/no-data.png')
@@ -0,0 +1,76 @@
+'''Module that keeps a local store of the monthly gallon totals of each BTU sensor, so
+that billing a month only needs that month's readings; the earlier months of the
+history graph come from the store.
+
+Only months that are closed are stored: months with readings after them, and with the
+prior reading of the month's first reading available when they were totaled.  The
+totals for each sensor are stored in a NumPy file in the cache folder holding, for
+each month, the total gallons, the timestamp of the last reading in the month and the
+timestamp of the reading before the month's first reading (see
+util.heat_calcs.get_gallon_data()).  A small JSON file alongside records the factor that
+converted the sensor values into gallons; stored totals are discarded if the factor
+changes, e.g. when the sensor's 'btu_mult' is changed.
+'''
+
+import json
+import os
+from urllib.parse import quote
+
+import numpy as np
+
+from util.cache import cache_path
+
+# The NumPy data type used to store the monthly totals.  'month' is the number of months
+# since January 1970; the timestamps are integer nanoseconds.
+ROLLUP_DTYPE = np.dtype([('month', '<i8'), ('gallons', '<f8'), ('ts', '<i8'), ('prior_ts', '<i8')])
+
+def _store_paths(sensor_id):
+    """Returns the paths to the totals file and the information file for 'sensor_id'.
+    """
+    fn = quote(sensor_id, safe='')
+    return cache_path('rollups', f'{fn}.npy'), cache_path('rollups', f'{fn}.json')
+
+def load_rollups(sensor_id, gal_factor):
+    """Returns the stored monthly totals for 'sensor_id' as a NumPy array of ROLLUP_DTYPE,
+    sorted by month.  'gal_factor' is the factor that converts the sensor values into
+    gallons; no totals are returned if they were stored with a different factor.
+    """
+    data_path, info_path = _store_paths(sensor_id)
+    if not (data_path.exists() and info_path.exists()):
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+
+    with open(info_path) as fh:
+        info = json.load(fh)
+    if info['gal_factor'] != gal_factor:
+        return np.empty(0, dtype=ROLLUP_DTYPE)
+    return np.load(data_path)
+
+def save_rollups(sensor_id, gal_factor, rollups):
+    """Adds the monthly totals in 'rollups' (NumPy array of ROLLUP_DTYPE) to those stored
+    for 'sensor_id', replacing stored totals for the same months.  'gal_factor' is the
+    factor that converted the sensor values into gallons.  The files are written to
+    temporary files first so the store is never left partially written.
+    """
+    if len(rollups) == 0:
+        return
+    stored = load_rollups(sensor_id, gal_factor)
+    combined = np.concatenate([stored[~np.isin(stored['month'], rollups['month'])], rollups])
+    combined = combined[np.argsort(combined['month'], kind='stable')]
+
+    data_path, info_path = _store_paths(sensor_id)
+    tmp_path = data_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as fh:
+        np.save(fh, combined)
+    os.replace(tmp_path, data_path)
+
+    tmp_path = info_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump({'gal_factor': gal_factor}, fh)
+    os.replace(tmp_path, info_path)
+
+def invalidate(sensor_id):
+    """Deletes the stored monthly totals for 'sensor_id' so they are calculated again
+    from the readings.
+    """
+    for path in _store_paths(sensor_id):
+        path.unlink(missing_ok=True)
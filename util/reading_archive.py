@@ -0,0 +1,108 @@
+'''Module that keeps an archive of raw sensor readings that can be read a date range at
+a time, without loading or decompressing the full set of readings as a pickle file
+requires.  It is used for the 'test-' sensors and is convenient for analyses of long
+runs of readings, e.g. in the 'heat_billing.ipynb' notebook or when backfilling.
+
+Each sensor's readings are stored in their own folder within the 'archive' folder of the
+cache folder, as two uncompressed NumPy files: 'ts.npy' holding the timestamps of the
+readings in time order (as integer nanoseconds), and 'val.npy' holding the values.  A
+small 'info.json' file records the name of the value column.  The files are opened
+memory-mapped and the readings in a date range are found by a binary search of the
+timestamps, so only the part of the files holding those readings is read from disk.
+
+Example:
+    from util import reading_archive
+    reading_archive.import_pickle('test-data/clean_dataset.pkl', 'clean')
+    df = reading_archive.archive_readings('clean', datetime(2021, 3, 1), datetime(2021, 3, 31))
+'''
+
+import json
+import os
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+
+from util.cache import cache_path
+
+def _archive_paths(sensor_id):
+    """Returns the paths to the timestamp, value and information files for 'sensor_id'.
+    """
+    fn = quote(sensor_id, safe='')
+    return (cache_path('archive', fn, 'ts.npy'), cache_path('archive', fn, 'val.npy'),
+            cache_path('archive', fn, 'info.json'))
+
+def has_archive(sensor_id):
+    """Returns True if readings for 'sensor_id' are in the archive.
+    """
+    return all(path.exists() for path in _archive_paths(sensor_id))
+
+def save_archive(sensor_id, df):
+    """Stores the readings in the DataFrame 'df', which has one column of values and
+    a DatetimeIndex, as the archived readings for 'sensor_id', replacing any readings
+    already archived.  The files are written to temporary files first so the archive
+    is never left partially written.
+    """
+    ts = df.index.values.astype('datetime64[ns]').view('i8')
+    values = df.iloc[:, 0].to_numpy()
+    if not np.all(ts[1:] >= ts[:-1]):
+        order = np.argsort(ts, kind='stable')
+        ts, values = ts[order], values[order]
+
+    ts_path, val_path, info_path = _archive_paths(sensor_id)
+    for path, arr in ((ts_path, ts), (val_path, values)):
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as fh:
+            np.save(fh, np.ascontiguousarray(arr))
+        os.replace(tmp_path, path)
+
+    tmp_path = info_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump({'column': str(df.columns[0])}, fh)
+    os.replace(tmp_path, info_path)
+
+def import_pickle(pickle_path, sensor_id):
+    """Archives the readings in the bz2 compressed pickle file of a DataFrame at
+    'pickle_path' (e.g. one of the datasets in 'test-data/') as the readings for
+    'sensor_id'.  Nothing is done if the archive was written after the pickle file.
+    """
+    ts_path = _archive_paths(sensor_id)[0]
+    if has_archive(sensor_id) and ts_path.stat().st_mtime >= os.path.getmtime(pickle_path):
+        return
+    save_archive(sensor_id, pd.read_pickle(pickle_path, compression='bz2'))
+
+def archive_slice(sensor_id, start_date=None, end_date=None):
+    """Returns the archived readings for 'sensor_id' from 'start_date' through 'end_date'
+    as read-only NumPy arrays of the timestamps (integer nanoseconds) and the values.
+    The arrays are views of the memory-mapped files, so nothing is copied.  A missing
+    'start_date' or 'end_date' leaves that end of the range open.
+    """
+    ts_path, val_path, _ = _archive_paths(sensor_id)
+    ts = np.load(ts_path, mmap_mode='r')
+    values = np.load(val_path, mmap_mode='r')
+    i_start = 0 if start_date is None else np.searchsorted(ts, pd.Timestamp(start_date).value, side='left')
+    i_end = len(ts) if end_date is None else np.searchsorted(ts, pd.Timestamp(end_date).value, side='right')
+    return ts[i_start:i_end], values[i_start:i_end]
+
+def archive_chunks(sensor_id, start_date=None, end_date=None, chunk_size=500_000):
+    """Yields the archived readings for 'sensor_id' from 'start_date' through 'end_date'
+    (see archive_slice()) in time order, as (timestamps, values) tuples of NumPy arrays
+    holding at most 'chunk_size' readings.  Each chunk is copied from the files as it is
+    yielded, so only one chunk is held in memory at a time.
+    """
+    ts, values = archive_slice(sensor_id, start_date, end_date)
+    for i in range(0, len(ts), chunk_size):
+        yield np.array(ts[i:i + chunk_size]), np.array(values[i:i + chunk_size])
+
+def archive_readings(sensor_id, start_date=None, end_date=None):
+    """Returns a Pandas DataFrame of the archived readings for 'sensor_id' from 'start_date'
+    through 'end_date' (see archive_slice()), with one column named as it was when the
+    readings were archived.  Only the readings in the range are copied from the files.
+    """
+    ts, values = archive_slice(sensor_id, start_date, end_date)
+    with open(_archive_paths(sensor_id)[2]) as fh:
+        info = json.load(fh)
+    return pd.DataFrame(
+        {info['column']: np.array(values)},
+        index=pd.DatetimeIndex(np.array(ts).view('datetime64[ns]')),
+    )
@@ -0,0 +1,248 @@
+'''Module that keeps a local store of BMON sensor readings, so that only the readings
+newer than those already stored need to be downloaded from the BMON server.
+
+Readings for each sensor are stored in a NumPy file holding the timestamp (as integer
+nanoseconds) and value of each reading.  A small JSON file alongside records the
+earliest date/time that has been requested from the BMON server for the sensor, and
+when the stored readings were last checked against the server.
+'''
+
+from datetime import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin
+
+import numpy as np
+import pandas as pd
+import requests
+from bmondata.server import check_response
+
+from util.cache import cache_path
+
+# The NumPy data type used to store readings for a sensor
+READING_DTYPE = np.dtype([('ts', '<i8'), ('val', '<f8')])
+
+# Number of times a failed download from BMON is retried, and the delay in seconds
+# before the first retry.  The delay doubles for each subsequent retry.
+FETCH_RETRIES = 3
+FETCH_RETRY_DELAY = 2.0
+
+# Seconds to wait for a response from the BMON server
+FETCH_TIMEOUT = 120
+
+# Stored readings checked against the BMON server at or after this date/time are used
+# without contacting the server again.  main.py sets it to the start of a run once
+# prefetch() has updated the store, so only the prefetch talks to the server.  If None,
+# the server is always checked for newer readings.
+fresh_since = None
+
+# Each thread keeps its own HTTP session so connections to the BMON server are reused.
+_thread_data = threading.local()
+
+def _session():
+    """Returns the HTTP session for the current thread.
+    """
+    if not hasattr(_thread_data, 'session'):
+        _thread_data.session = requests.Session()
+    return _thread_data.session
+
+def _store_paths(sensor_id):
+    """Returns the paths to the readings file and the information file for 'sensor_id'.
+    """
+    fn = quote(sensor_id, safe='')
+    return cache_path('readings', f'{fn}.npy'), cache_path('readings', f'{fn}.json')
+
+def _load_info(sensor_id):
+    """Returns the dictionary held in the information file for 'sensor_id', or None if
+    there are no stored readings.
+    """
+    data_path, info_path = _store_paths(sensor_id)
+    if not (data_path.exists() and info_path.exists()):
+        return None
+    with open(info_path) as fh:
+        return json.load(fh)
+
+def _save_info(sensor_id, start, checked):
+    """Writes the information file for 'sensor_id': 'start' is the earliest date/time
+    that has been requested from BMON for the sensor and 'checked' the date/time the
+    stored readings were last checked against the server.
+    """
+    _, info_path = _store_paths(sensor_id)
+    tmp_path = info_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as fh:
+        json.dump({'start': start.isoformat(), 'checked': checked.isoformat()}, fh)
+    os.replace(tmp_path, info_path)
+
+def load_readings(sensor_id):
+    """Returns the stored readings for 'sensor_id' as a NumPy array of READING_DTYPE and
+    the earliest date/time that has been requested for the sensor (None if there are
+    no stored readings).
+    """
+    info = _load_info(sensor_id)
+    if info is None:
+        return np.empty(0, dtype=READING_DTYPE), None
+    return np.load(_store_paths(sensor_id)[0]), datetime.fromisoformat(info['start'])
+
+def save_readings(sensor_id, readings, start, checked=None):
+    """Stores the 'readings' (NumPy array of READING_DTYPE) for 'sensor_id'.  'start' is
+    the earliest date/time that has been requested from BMON for the sensor, and
+    'checked' the date/time the readings were checked against the server (default now).
+    The files are written to temporary files first so the store is never left partially
+    written.
+    """
+    data_path, _ = _store_paths(sensor_id)
+    tmp_path = data_path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as fh:
+        np.save(fh, readings)
+    os.replace(tmp_path, data_path)
+    _save_info(sensor_id, start, checked or datetime.now())
+
+def invalidate(sensor_id):
+    """Deletes the stored readings for 'sensor_id' so they are downloaded again when
+    next requested.
+    """
+    for path in _store_paths(sensor_id):
+        path.unlink(missing_ok=True)
+
+def fetch_readings(bmon_server_url, sensor_id, start_date, end_date):
+    """Downloads the readings for 'sensor_id' from 'start_date' through 'end_date'
+    from the BMON server at 'bmon_server_url'.  Returns a NumPy array of READING_DTYPE.
+    Connection problems and server errors are retried FETCH_RETRIES times, with an 
+    increasing delay between tries.
+    """
+    params = {
+        'sensor_id': [sensor_id],
+        'start_ts': str(start_date),
+        'end_ts': str(end_date),
+    }
+    url = urljoin(bmon_server_url, 'api/v2/readings/')
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            resp = _session().get(url, params=params, timeout=FETCH_TIMEOUT)
+            resp.raise_for_status()
+            resp_data = check_response(resp.json())['data']['readings']
+            break
+        except (requests.RequestException, RuntimeError):
+            if attempt == FETCH_RETRIES:
+                raise
+            time.sleep(FETCH_RETRY_DELAY * 2 ** attempt)
+
+    readings = np.empty(len(resp_data['index']), dtype=READING_DTYPE)
+    readings['ts'] = pd.to_datetime(resp_data['index']).values.astype('datetime64[ns]').view('i8')
+    readings['val'] = [row[0] for row in resp_data['data']]
+    return readings
+
+def merge_readings(*reading_arrays):
+    """Merges arrays of readings into one array sorted by timestamp.  Where a timestamp
+    appears more than once, the reading from the latest array is kept.
+    """
+    readings = np.concatenate(reading_arrays)
+    # stable sort so that duplicates are kept in the order of the arrays
+    readings = readings[np.argsort(readings['ts'], kind='stable')]
+    if len(readings):
+        keep = np.append(readings['ts'][1:] != readings['ts'][:-1], True)
+        readings = readings[keep]
+    return readings
+
+def update_readings(bmon_server_url, sensor_id, start_date, end_date):
+    """Makes sure the local store holds the readings for 'sensor_id' from 'start_date' 
+    through 'end_date' and returns all of the stored readings for the sensor.  Only 
+    readings earlier than the range already requested or newer than the last stored
+    reading are downloaded from the BMON server at 'bmon_server_url'.
+    """
+    checked = datetime.now()
+    readings, stored_start = load_readings(sensor_id)
+
+    new_readings = [readings]
+    if stored_start is not None:
+        # get readings newer than the last stored reading
+        last_ts = pd.Timestamp(readings['ts'][-1]).to_pydatetime() if len(readings) else stored_start
+        if end_date > last_ts:
+            new_readings.append(fetch_readings(bmon_server_url, sensor_id, last_ts, end_date))
+
+    if stored_start is None or start_date < stored_start:
+        # Need readings earlier than those requested before.
+        fetch_end = end_date if stored_start is None else stored_start
+        new_readings.append(fetch_readings(bmon_server_url, sensor_id, start_date, fetch_end))
+        stored_start = start_date
+
+    if len(new_readings) > 1:
+        readings = merge_readings(*new_readings)
+        save_readings(sensor_id, readings, stored_start, checked)
+    else:
+        _save_info(sensor_id, stored_start, checked)
+
+    return readings
+
+def is_fresh(sensor_id, start_date):
+    """Returns True if the stored readings for 'sensor_id' reach back to 'start_date' and
+    were checked against the BMON server at or after 'fresh_since', so they can be used
+    without contacting the server.
+    """
+    info = _load_info(sensor_id)
+    if fresh_since is None or info is None or 'checked' not in info:
+        return False
+    return (datetime.fromisoformat(info['checked']) >= fresh_since 
+            and datetime.fromisoformat(info['start']) <= start_date)
+
+def sensor_readings(bmon_server_url, sensor_id, start_date, end_date):
+    """Returns a Pandas DataFrame of the readings for 'sensor_id' from 'start_date' through
+    'end_date', with one column named 'sensor_id'.  Readings are served from the local
+    store, which is first updated from the BMON server at 'bmon_server_url' if needed,
+    unless it was updated in this run (see is_fresh()).
+    """
+    if is_fresh(sensor_id, start_date):
+        readings, _ = load_readings(sensor_id)
+    else:
+        readings = update_readings(bmon_server_url, sensor_id, start_date, end_date)
+
+    # return the requested date range
+    ts = readings['ts']
+    i_start = np.searchsorted(ts, pd.Timestamp(start_date).value, side='left')
+    i_end = np.searchsorted(ts, pd.Timestamp(end_date).value, side='right')
+    readings = readings[i_start:i_end]
+    return pd.DataFrame(
+        {sensor_id: readings['val']}, 
+        index=pd.DatetimeIndex(readings['ts'].astype('datetime64[ns]'))
+    )
+
+def stored_chunks(sensor_id, start_date, end_date, chunk_size):
+    """Yields the stored readings for 'sensor_id' from 'start_date' through 'end_date' in
+    time order, as (timestamps, values) tuples of NumPy arrays holding at most 'chunk_size'
+    readings; the timestamps are integer nanoseconds.  The readings file is memory-mapped
+    and each chunk copied from it as it is yielded, so only one chunk is held in memory
+    at a time.  The store is not updated from the BMON server; see prefetch().
+    """
+    data_path, _ = _store_paths(sensor_id)
+    if not data_path.exists():
+        return
+    readings = np.load(data_path, mmap_mode='r')
+    i_start = np.searchsorted(readings['ts'], pd.Timestamp(start_date).value, side='left')
+    i_end = np.searchsorted(readings['ts'], pd.Timestamp(end_date).value, side='right')
+    for i in range(i_start, i_end, chunk_size):
+        chunk = np.array(readings[i:min(i + chunk_size, i_end)])
+        yield chunk['ts'], chunk['val']
+
+def prefetch(bmon_server_url, sensor_ids, start_date, end_date, max_threads=8):
+    """Updates the local store for all of the 'sensor_ids' at once, so the readings from
+    'start_date' through 'end_date' are available without waiting on the BMON server.
+    Up to 'max_threads' downloads are run concurrently.  Returns a dictionary mapping
+    Sensor ID to the Exception raised for each sensor that could not be updated.
+    """
+    sensor_ids = sorted(set(sensor_ids))
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_threads)) as executor:
+        futures = {
+            sensor_id: executor.submit(update_readings, bmon_server_url, sensor_id, start_date, end_date)
+            for sensor_id in sensor_ids
+        }
+        for sensor_id, fut in futures.items():
+            try:
+                fut.result()
+            except Exception as err:
+                errors[sensor_id] = err
+
+    return errors
@@ -0,0 +1,146 @@
+'''Module that stores the summary results of each report created, which are needed
+to email the reports.  The results are kept in a SQLite database in the report folder,
+with one row per report, indexed by customer, BTU sensor and billing month.  Each
+report's results are written in their own transaction, so an interrupted run loses at
+most the report being saved.
+'''
+
+from datetime import datetime
+import math
+import pickle
+import sqlite3
+
+# Name of the results database file in the report folder
+RESULTS_FILE = 'results.sqlite'
+
+# Name of the pickle file that held the results before the database was used.  Its
+# contents are imported when the database is created.
+OLD_RESULTS_FILE = 'results.pkl'
+
+# Columns holding the summary results of a report, and their SQLite types
+SUMMARY_COLUMNS = {
+    'gal_saved': 'REAL',
+    'bill_start': 'TEXT',
+    'bill_end': 'TEXT',
+    'billed_price': 'REAL',
+    'cust_price': 'REAL',
+}
+
+_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS results (
+    report_fn TEXT PRIMARY KEY,
+    city TEXT NOT NULL,
+    customer TEXT NOT NULL,
+    sensor_id TEXT,
+    bill_year INTEGER NOT NULL,
+    bill_month INTEGER NOT NULL,
+    {', '.join(f'{col} {typ}' for col, typ in SUMMARY_COLUMNS.items())},
+    saved TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_customer ON results (city, customer, bill_year, bill_month);
+CREATE INDEX IF NOT EXISTS results_sensor ON results (sensor_id, bill_year, bill_month);
+CREATE INDEX IF NOT EXISTS results_month ON results (bill_year, bill_month);
+'''
+
+def _to_db(col, val):
+    """Converts the summary value 'val' for column 'col' to a value stored in SQLite.
+    """
+    if val is None:
+        return None
+    if SUMMARY_COLUMNS[col] == 'TEXT':
+        return val.isoformat()
+    return float(val)
+
+def _from_db(col, val):
+    """Converts the SQLite value 'val' for column 'col' back to a summary value.  SQLite
+    stores NaN as NULL, so NULL numbers are returned as NaN.
+    """
+    if SUMMARY_COLUMNS[col] == 'TEXT':
+        return None if val is None else datetime.fromisoformat(val)
+    return math.nan if val is None else val
+
+def _row_to_dict(row):
+    """Returns a dictionary of the values in the 'row' from the results table.
+    """
+    rec = dict(row)
+    for col in SUMMARY_COLUMNS:
+        rec[col] = _from_db(col, rec[col])
+    return rec
+
+def _import_pickle(conn, pickle_path):
+    """Imports the results from the old results pickle file at 'pickle_path', which is a
+    dictionary keyed by report file name.  The billing month, city and customer are
+    parsed from the report file name; the sensor ID is not known.
+    """
+    with open(pickle_path, 'rb') as fh:
+        old_results = pickle.load(fh)
+    for report_fn, summary in old_results.items():
+        try:
+            month, city, customer = report_fn[:-len('.pdf')].split(' - ', 2)
+            bill_year, bill_month = (int(part) for part in month.split('-'))
+        except ValueError:
+            continue
+        save_result(conn, report_fn, city, customer, None, bill_year, bill_month, summary)
+
+def open_results(report_folder):
+    """Opens the results database in 'report_folder', creating it if it does not exist.
+    A new database is loaded with any results from the old 'results.pkl' file in the folder.
+    Returns a sqlite3.Connection.
+    """
+    db_path = report_folder / RESULTS_FILE
+    is_new = not db_path.exists()
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    with conn:
+        conn.executescript(_SCHEMA)
+    pickle_path = report_folder / OLD_RESULTS_FILE
+    if is_new and pickle_path.exists():
+        _import_pickle(conn, pickle_path)
+    return conn
+
+def save_result(conn, report_fn, city, customer, sensor_id, bill_year, bill_month, summary):
+    """Saves the 'summary' results dictionary of the report named 'report_fn', replacing
+    any results previously saved for the report.  The results are committed before
+    returning.
+    """
+    values = [_to_db(col, summary[col]) for col in SUMMARY_COLUMNS]
+    with conn:
+        conn.execute(
+            f'''INSERT OR REPLACE INTO results
+                (report_fn, city, customer, sensor_id, bill_year, bill_month, {', '.join(SUMMARY_COLUMNS)}, saved)
+                VALUES ({', '.join('?' * (len(SUMMARY_COLUMNS) + 7))})''',
+            [report_fn, city, customer, sensor_id, bill_year, bill_month, *values, datetime.now().isoformat()]
+        )
+
+def get_result(conn, city, customer, bill_year, bill_month):
+    """Returns a dictionary of the results for the customer's report for the billing month,
+    or None if no results have been saved.
+    """
+    row = conn.execute(
+        'SELECT * FROM results WHERE city = ? AND customer = ? AND bill_year = ? AND bill_month = ?',
+        (city, customer, bill_year, bill_month)
+    ).fetchone()
+    return None if row is None else _row_to_dict(row)
+
+def report_history(conn, city=None, customer=None, sensor_id=None, first_month=None, last_month=None):
+    """Returns a list of results dictionaries, ordered by billing month, for the reports
+    matching all of the criteria given: 'city', 'customer', 'sensor_id', and billing months
+    from 'first_month' through 'last_month', which are (year, month) tuples.
+    """
+    conditions, params = [], []
+    for col, val in (('city', city), ('customer', customer), ('sensor_id', sensor_id)):
+        if val is not None:
+            conditions.append(f'{col} = ?')
+            params.append(val)
+    if first_month is not None:
+        conditions.append('(bill_year, bill_month) >= (?, ?)')
+        params.extend(first_month)
+    if last_month is not None:
+        conditions.append('(bill_year, bill_month) <= (?, ?)')
+        params.extend(last_month)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    rows = conn.execute(
+        f'SELECT * FROM results {where} ORDER BY bill_year, bill_month, city, customer',
+        params
+    )
+    return [_row_to_dict(row) for row in rows]
@@ -0,0 +1,150 @@
+'''Module that generates synthetic readings of a cumulative BTU meter, for testing the
+calculations and running the whole program at scale without a BMON server.
+
+The synthetic sensors are used through the 'test-' sensor mechanism of
+util.heat_calcs.sensor_readings(): a Sensor ID of 'test-synthetic' gives a meter
+with the default settings below, and settings can be changed by listing them after
+a colon, e.g. 'test-synthetic:interval=1,resets=2,gaps=1,nan=0.01,seed=7'.
+
+The meter counts up at a rate (BTU/hour) that is highest in winter and in the early
+morning, with random variation.  Counter resets, gaps of several days, randomly
+dropped readings and NaN values can be added.  The random values are derived from the
+reading times, and resets and gaps are placed by calendar year, so a meter gives the
+same reading times, NaN values and BTUs between readings whatever range of readings is
+requested, as a real meter does.  Only the arbitrary starting count of the meter
+depends on the start of the range.
+'''
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# Settings of a synthetic meter and their default values
+DEFAULTS = {
+    'interval': 60.0,       # minutes between readings
+    'peak': 60000.0,        # average BTU/hour on the coldest day of the year
+    'base': 0.25,           # average on the warmest day, as a fraction of 'peak'
+    'coldest_day': 20.0,    # day of the year with the highest load
+    'diurnal': 0.2,         # daily swing of the load, as a fraction of the average
+    'noise': 0.15,          # standard deviation of the random variation, as a fraction
+    'resets': 0.0,          # average number of counter resets per year
+    'gaps': 0.0,            # average number of gaps in the readings per year
+    'gap_days': 20.0,       # length of each gap in days
+    'drop': 0.0,            # fraction of readings randomly missing
+    'nan': 0.0,             # fraction of readings that are NaN
+    'seed': 0.0,            # seed for the random numbers
+}
+
+# Name of the column holding the readings, as in the datasets in 'test-data/'
+COLUMN_NAME = 'BTU_metered'
+
+def parse_settings(name):
+    """Returns the dictionary of settings for the synthetic sensor 'name', which is the
+    part of the Sensor ID following 'test-', e.g. 'synthetic:interval=5,resets=1'.
+    """
+    settings = dict(DEFAULTS)
+    _, _, options = name.partition(':')
+    for option in filter(None, options.split(',')):
+        key, _, value = option.partition('=')
+        key = key.strip()
+        if key not in DEFAULTS:
+            raise ValueError(f"Unknown synthetic sensor setting '{key}' in '{name}'.")
+        settings[key] = float(value)
+    return settings
+
+def _year_events(seed, kind, years, per_year):
+    """Returns a sorted array of the times (datetime64[ns]) of random events of type 'kind'
+    in each of the calendar 'years', about 'per_year' of them in each year.  The events
+    of a year depend only on 'seed', 'kind' and the year.
+    """
+    times = []
+    for year in years:
+        rng = np.random.default_rng([int(seed), kind, year])
+        count = rng.poisson(per_year) if per_year > 0 else 0
+        start = np.datetime64(f'{year}-01-01', 'ns')
+        length = np.datetime64(f'{year + 1}-01-01', 'ns') - start
+        times.append(start + (rng.random(count) * length.astype(np.int64)).astype('timedelta64[ns]'))
+    return np.sort(np.concatenate(times)) if times else np.empty(0, dtype='datetime64[ns]')
+
+def _uniform(ts, seed, stream):
+    """Returns an array of random numbers from 0 to 1, one for each of the integer
+    nanosecond timestamps 'ts', that depend only on the timestamp, 'seed' and 'stream'
+    (an integer distinguishing different uses of the numbers).  The numbers are made
+    by the SplitMix64 hash of the timestamp.
+    """
+    x = ts.view(np.uint64) + np.uint64((int(seed) * 8 + stream) * 0x9E3779B97F4A7C15 % 2**64)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return (x >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+def synthetic_readings(start_date, end_date, **settings):
+    """Returns the readings of a synthetic meter from 'start_date' through 'end_date' as
+    a tuple of NumPy arrays: timestamps (datetime64[ns]) and cumulative BTUs.  'settings'
+    override the values in DEFAULTS.
+    """
+    opts = dict(DEFAULTS, **settings)
+    unknown = set(settings) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown synthetic sensor settings: {', '.join(sorted(unknown))}")
+    seed = int(opts['seed'])
+
+    # reading times on a regular grid
+    step = np.timedelta64(int(opts['interval'] * 60e9), 'ns')
+    start, end = np.datetime64(start_date, 'ns'), np.datetime64(end_date, 'ns')
+    first = start + (-(start - np.datetime64(0, 'ns')) % step)
+    ts = np.arange(first, end + np.timedelta64(1, 'ns'), step)
+    if len(ts) == 0:
+        return ts, np.empty(0)
+
+    # rate in BTU/hour: seasonal and daily shape, with random variation
+    ts_ns = ts.view(np.int64)
+    normal = np.sqrt(-2.0 * np.log(1.0 - _uniform(ts_ns, seed, 0))) * np.cos(2 * np.pi * _uniform(ts_ns, seed, 1))
+    days = ts.astype('datetime64[D]')
+    day_of_year = (days - days.astype('datetime64[Y]')).astype(np.float64)
+    hour = (ts - days).astype(np.float64) / 3600e9
+    season = 0.5 + 0.5 * np.cos(2 * np.pi * (day_of_year - opts['coldest_day']) / 365.25)
+    rate = opts['peak'] * (opts['base'] + (1.0 - opts['base']) * season)
+    rate *= 1.0 + opts['diurnal'] * np.cos(2 * np.pi * (hour - 6.0) / 24.0)
+    rate *= np.clip(1.0 + opts['noise'] * normal, 0.0, None)
+
+    # cumulative count, starting from an arbitrary meter value
+    hours = np.diff(ts, prepend=ts[0] - step).astype(np.float64) / 3600e9
+    btus = 1e8 + np.cumsum(rate * hours)
+
+    years = range(first.astype('datetime64[Y]').astype(int) + 1970, end.astype('datetime64[Y]').astype(int) + 1971)
+
+    # counter resets: the count restarts from zero after each reset
+    resets = _year_events(seed, 1, years, opts['resets'])
+    resets = resets[(resets >= ts[0]) & (resets <= ts[-1])]
+    if len(resets):
+        reset_ix = np.searchsorted(ts, resets)
+        last_reset = np.zeros(len(ts), dtype=np.int64)
+        last_reset[reset_ix] = reset_ix
+        last_reset = np.maximum.accumulate(last_reset)
+        after_reset = last_reset > 0
+        btus[after_reset] -= btus[last_reset[after_reset] - 1]
+
+    keep = np.ones(len(ts), dtype=bool)
+
+    # gaps with no readings, including gaps starting in earlier years that run into the
+    # requested range
+    gap_years = range(years.start - math.ceil(opts['gap_days'] / 365), years.stop)
+    for gap_start in _year_events(seed, 2, gap_years, opts['gaps']):
+        gap_end = gap_start + np.timedelta64(int(opts['gap_days'] * 86400e9), 'ns')
+        keep[np.searchsorted(ts, gap_start):np.searchsorted(ts, gap_end)] = False
+
+    # randomly dropped readings and NaN values
+    keep &= _uniform(ts_ns, seed, 2) >= opts['drop']
+    btus[_uniform(ts_ns, seed, 3) < opts['nan']] = np.nan
+
+    return ts[keep], btus[keep]
+
+def sensor_readings(name, start_date, end_date):
+    """Returns a Pandas DataFrame of the readings of the synthetic sensor 'name' (the part
+    of the Sensor ID following 'test-') from 'start_date' through 'end_date', in the same
+    form as the datasets in 'test-data/'.
+    """
+    ts, btus = synthetic_readings(start_date, end_date, **parse_settings(name))
+    return pd.DataFrame({COLUMN_NAME: btus}, index=pd.DatetimeIndex(ts))
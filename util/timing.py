@@ -0,0 +1,100 @@
+'''Module that times the stages of a run (retrieving readings, calculations, graphs,
+PDF creation, email), so the cause of a slow run can be found.
+
+Code that does a stage wraps it in span(); the time is recorded along with the labels
+(e.g. customer and billing month) set by the enclosing labels() blocks in the same thread.
+If tracemalloc is tracing, the peak memory used during the span is recorded as well.
+'''
+
+from contextlib import contextmanager
+import json
+import threading
+import time
+import tracemalloc
+
+# The recorded spans: dictionaries holding the labels, 'stage', 'seconds' and, when
+# tracemalloc is tracing, 'peak_mb'.
+records = []
+
+_lock = threading.Lock()
+_local = threading.local()
+
+def current_labels():
+    """Returns the dictionary of labels in effect in this thread.
+    """
+    stack = getattr(_local, 'labels', None)
+    return stack[-1] if stack else {}
+
+@contextmanager
+def labels(**new_labels):
+    """Context manager that adds 'new_labels' to the spans recorded within it.
+    """
+    if not hasattr(_local, 'labels'):
+        _local.labels = []
+    _local.labels.append({**current_labels(), **new_labels})
+    try:
+        yield
+    finally:
+        _local.labels.pop()
+
+@contextmanager
+def span(stage):
+    """Context manager that records the time taken by the 'stage' within it.
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec = dict(current_labels(), stage=stage, seconds=time.perf_counter() - st)
+        if tracing:
+            rec['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        with _lock:
+            records.append(rec)
+
+def add_records(new_records):
+    """Adds spans recorded elsewhere, e.g. in a worker process, to the recorded spans.
+    """
+    with _lock:
+        records.extend(new_records)
+
+def take_records():
+    """Returns the recorded spans and clears them.
+    """
+    with _lock:
+        taken = records[:]
+        records.clear()
+    return taken
+
+def summary_table(key='customer'):
+    """Returns a Rich Table of the total seconds in each stage for each value of the label
+    'key', slowest first.  Spans without the label, e.g. the email of a report, are
+    grouped by their 'report' label or shown as the whole run.
+    """
+    from rich.table import Table
+
+    stages = list(dict.fromkeys(rec['stage'] for rec in records))
+    totals = {}
+    for rec in records:
+        row_key = rec.get(key) or rec.get('report') or '(whole run)'
+        row = totals.setdefault(row_key, dict.fromkeys(stages, 0.0))
+        row[rec['stage']] += rec['seconds']
+
+    table = Table(title='Seconds in each stage')
+    table.add_column(key.replace('_', ' ').title())
+    for stage in stages + ['total']:
+        table.add_column(stage, justify='right')
+    for row_key, row in sorted(totals.items(), key=lambda item: -sum(item[1].values())):
+        table.add_row(row_key, *[f'{row[stage]:.2f}' if row[stage] else '' for stage in stages],
+                      f'{sum(row.values()):.2f}')
+    stage_totals = [sum(row[stage] for row in totals.values()) for stage in stages]
+    table.add_row('All', *[f'{total:.2f}' for total in stage_totals], f'{sum(stage_totals):.2f}', style='bold')
+    return table
+
+def write_json(path):
+    """Writes the recorded spans to the JSON file at 'path'.
+    """
+    with open(path, 'w') as fh:
+        json.dump(records, fh, indent=2)